@@ -0,0 +1,259 @@
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+from stack import ComposeStack, LocalStack, parse_size
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+DATA_DIR = os.getenv("BENCH_DATA_DIR", "/tmp/megaapi-bench")
+REQUEST_TIMEOUT = 600  # seconds; split-hash on large files takes a while
+
+# --- Scenarios ---
+# An operation takes the client, the stack's URLs and a sequence number, and
+# raises if it failed. It may make several requests (e.g. a job broker cycle).
+Operation = Callable[[httpx.AsyncClient, dict, int], Awaitable[None]]
+
+@dataclass
+class Scenario:
+    services: list[str]  # started in this order in local mode
+    setup: Callable[[argparse.Namespace], Callable[..., Operation]]
+    containers: list[str]  # whose memory is sampled in compose mode
+
+def calculate(args) -> Operation:
+    # api /calculate: api -> proxy_pusher -> RabbitMQ -> proxy_popper -> addition/subtraction
+    async def operation(client, urls, i):
+        resp = await client.post(f"{urls['api']}/calculate", json={"x": i})
+        resp.raise_for_status()
+    return operation
+
+def test_file(size: int) -> str:
+    # Generated once per size and reused across runs
+    path = os.path.join(DATA_DIR, f"input-{size}.bin")
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            remaining = size
+            while remaining:
+                block = os.urandom(min(remaining, 4 * 1024 * 1024))
+                f.write(block)
+                remaining -= len(block)
+        os.replace(path + ".tmp", path)
+    return path
+
+def split_hash(args) -> Operation:
+    path = test_file(args.file_size)
+
+    async def operation(client, urls, i):
+        with open(path, "rb") as f:
+            resp = await client.post(
+                f"{urls['api']}/split-hash",
+                params={"mode": args.split_mode, "chunk_size": args.chunk_size, "transport": args.transport},
+                files={"file": ("input.bin", f, "application/octet-stream")},
+            )
+        resp.raise_for_status()
+    return operation
+
+def job_broker(args) -> Operation:
+    # One full cycle per operation: submit, fetch, complete
+    async def operation(client, urls, i):
+        base = urls["job_broker"]
+        resp = await client.post(f"{base}/submit/bench", json={"payload": {"i": i}})
+        resp.raise_for_status()
+        resp = await client.post(f"{base}/fetch_job/bench", params={"wait": 5})
+        resp.raise_for_status()
+        task_id = resp.json()["task_id"]
+        resp = await client.post(f"{base}/complete/bench/{task_id}", json={"result": {"ok": True}})
+        resp.raise_for_status()
+    return operation
+
+def async_jobs(args) -> Operation:
+    # X-Async-Request on the addition service, then long-poll for the result
+    async def operation(client, urls, i):
+        base = urls["addition"]
+        resp = await client.post(f"{base}/add", json={"a": i, "b": 1}, headers={"X-Async-Request": "true"})
+        resp.raise_for_status()
+        job_id = resp.json()["job_id"]
+        resp = await client.get(f"{base}/job_result/{job_id}", params={"wait": 30})
+        if resp.status_code != 200:
+            raise RuntimeError(f"Job {job_id} answered {resp.status_code}")
+    return operation
+
+SCENARIOS = {
+    "calculate": Scenario(
+        ["addition", "subtraction", "proxy_pusher", "addition_popper", "subtraction_popper", "api"],
+        calculate,
+        ["api", "proxy_pusher", "addition_popper", "subtraction_popper", "addition", "subtraction", "rabbitmq"],
+    ),
+    "split_hash": Scenario(["file_splitter", "file_hasher", "api"], split_hash, ["api", "file_splitter", "file_hasher"]),
+    "job_broker": Scenario(["job_broker"], job_broker, ["job_broker", "rabbitmq", "redis"]),
+    "async_jobs": Scenario(["addition"], async_jobs, ["addition", "redis"]),
+}
+
+# --- Load ---
+async def drive(operation: Operation, urls: dict, concurrency: int, duration: float, requests: int, warmup: int) -> dict:
+    # Closed loop: `concurrency` workers each run one operation after another
+    # until `requests` operations have been started or `duration` has passed
+    latencies = []
+    errors = []
+    counter = iter(range(sys.maxsize))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits) as client:
+        for i in range(warmup):
+            await operation(client, urls, -1 - i)
+        started = time.perf_counter()
+        deadline = started + duration if duration else None
+
+        async def worker():
+            while True:
+                i = next(counter)
+                if (requests and i >= requests) or (deadline and time.perf_counter() >= deadline):
+                    return
+                op_started = time.perf_counter()
+                try:
+                    await operation(client, urls, i)
+                except Exception as e:
+                    errors.append(repr(e))
+                    continue
+                latencies.append(time.perf_counter() - op_started)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, errors, elapsed)
+
+def percentile(ordered: list[float], p: float) -> float:
+    # Nearest-rank
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def summarize(latencies: list[float], errors: list[str], elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 2)
+    return {
+        "operations": len(latencies),
+        "errors": len(errors),
+        "sample_errors": sorted(set(errors))[:5],
+        "elapsed_s": round(elapsed, 2),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": ms(statistics.fmean(ordered)) if ordered else 0.0,
+            "p50": ms(percentile(ordered, 50)),
+            "p95": ms(percentile(ordered, 95)),
+            "p99": ms(percentile(ordered, 99)),
+            "max": ms(ordered[-1]) if ordered else 0.0,
+        },
+    }
+
+# --- Baselines ---
+def baseline_path(scenario: str, mode: str) -> str:
+    return os.path.join(BASELINE_DIR, f"{scenario}-{mode}.json")
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=BENCH_DIR).stdout.strip()
+    except OSError:
+        return ""
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    # Regressions beyond `tolerance` (a fraction): lower throughput, higher
+    # tail latency or higher peak memory
+    regressions = []
+
+    def check(label, new, old, higher_is_worse=True):
+        if not old:
+            return
+        change = (new - old) / old
+        print(f"  {label:<28} {old:>10} -> {new:>10} ({change:+.1%})")
+        if (change > tolerance) if higher_is_worse else (change < -tolerance):
+            regressions.append(f"{label}: {old} -> {new} ({change:+.1%})")
+
+    print(f"Compared with baseline from {baseline.get('recorded_at', '?')} ({baseline.get('commit', '?')}):")
+    check("rps", current["rps"], baseline["rps"], higher_is_worse=False)
+    for p in ("p50", "p95", "p99"):
+        check(f"latency {p} (ms)", current["latency_ms"][p], baseline["latency_ms"][p])
+    for service, peak in current["peak_rss_mb"].items():
+        check(f"peak rss {service} (MB)", peak, baseline.get("peak_rss_mb", {}).get(service))
+    return regressions
+
+def run(args) -> int:
+    scenario = SCENARIOS[args.scenario]
+    operation = scenario.setup(args)
+    if args.mode == "local":
+        stack = LocalStack(scenario.services)
+    else:
+        stack = ComposeStack(scenario.containers)
+        stack.urls.update(dict(url.split("=", 1) for url in args.url))
+        missing = [name for name in scenario.services if name not in stack.urls]
+        if missing:
+            print(f"No compose URL for {', '.join(missing)}; pass --url SERVICE=URL")
+            return 2
+    with stack:
+        result = asyncio.run(drive(operation, stack.urls, args.concurrency, args.duration, args.requests, args.warmup))
+        result["peak_rss_mb"] = stack.peak_rss_mb()
+    report = {
+        "scenario": args.scenario,
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "commit": git_commit(),
+        "recorded_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        **result,
+    }
+    print(json.dumps(report, indent=2))
+
+    status = 0
+    path = args.baseline or baseline_path(args.scenario, args.mode)
+    if args.compare:
+        if not os.path.exists(path):
+            print(f"No baseline at {path}")
+            return 1
+        with open(path) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            status = 1
+    if args.save:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Saved baseline to {path}")
+    if report["errors"]:
+        status = 1
+    return status
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load and latency benchmarks for the MegaAPI services")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--mode", choices=["local", "compose"], default="local",
+                        help="local: start the services as local processes; compose: use the running docker-compose stack")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run (0 to only count requests)")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many operations (0 for no limit)")
+    parser.add_argument("--warmup", type=int, default=5, help="operations run before measuring")
+    parser.add_argument("--url", action="append", default=[], metavar="SERVICE=URL",
+                        help="override a service URL in compose mode, e.g. job_broker=http://localhost:8020")
+    parser.add_argument("--file-size", type=parse_size, default="100MB", help="split_hash input size, e.g. 100MB or 2GB")
+    parser.add_argument("--chunk-size", type=parse_size, default="1MB", help="split_hash part size")
+    parser.add_argument("--split-mode", choices=["parts", "tree"], default="parts")
+    parser.add_argument("--transport", choices=["http", "blob"], default="http",
+                        help="split_hash: pass file bodies over HTTP or blob references")
+    parser.add_argument("--save", action="store_true", help="store the result as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare with the baseline; exit 1 on regressions")
+    parser.add_argument("--baseline", help="baseline file (default: baselines/<scenario>-<mode>.json)")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed change before it counts as a regression")
+    args = parser.parse_args()
+    if not args.duration and not args.requests:
+        parser.error("Set --duration or --requests")
+    return run(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+from dataclasses import dataclass
+from typing import Callable, Optional
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import httpx
+
+SUBPROJECTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "subprojects")
+LOCAL_HOST = "127.0.0.1"
+LOCAL_BASE_PORT = int(os.getenv("BENCH_BASE_PORT", 18000))
+RABBITMQ_HOST = os.getenv("BENCH_RABBITMQ_HOST", "localhost")
+REDIS_URL = os.getenv("BENCH_REDIS_URL", "redis://localhost:6379/0")
+BLOB_DIR = os.getenv("BENCH_BLOB_DIR", "/tmp/megaapi-bench/blobs")  # shared by the local services
+STARTUP_TIMEOUT = 60  # seconds a service may take to answer
+
+@dataclass
+class Service:
+    name: str
+    subproject: str  # directory under subprojects/
+    # Extra environment, given the base URL of every service in the stack
+    env: Callable[[dict], dict] = lambda urls: {}
+
+# Mirrors docker-compose.yml, with every service on localhost
+SERVICES = {service.name: service for service in [
+    Service("addition", "addition"),
+    Service("subtraction", "subtraction"),
+    Service("file_splitter", "file_splitter"),
+    Service("file_hasher", "file_hasher"),
+    Service("proxy_pusher", "proxy_pusher", lambda urls: {"RABBITMQ_HOST": RABBITMQ_HOST}),
+    Service("addition_popper", "proxy_popper", lambda urls: {
+        "RABBITMQ_HOST": RABBITMQ_HOST,
+        "SERVICE_NAME": "addition",
+        "DOWNSTREAM_URL": f"{urls['addition']}/add",
+        "PREFETCH_COUNT": "16",
+        "BATCH_SIZE": "32",
+        "BATCH_WAIT_MS": "5",
+    }),
+    Service("subtraction_popper", "proxy_popper", lambda urls: {
+        "RABBITMQ_HOST": RABBITMQ_HOST,
+        "SERVICE_NAME": "subtraction",
+        "DOWNSTREAM_URL": f"{urls['subtraction']}/subtract",
+        "PREFETCH_COUNT": "16",
+        "BATCH_SIZE": "32",
+        "BATCH_WAIT_MS": "5",
+    }),
+    Service("api", "api", lambda urls: {
+        "ADDITION_URL": f"{urls['proxy_pusher']}/proxy/addition",
+        "SUBTRACTION_URL": f"{urls['proxy_pusher']}/proxy/subtraction",
+        "FILE_SPLITTER_URL": f"{urls['file_splitter']}/split",
+        "FILE_HASHER_URL": f"{urls['file_hasher']}/hash",
+    }),
+    Service("job_broker", "job_broker", lambda urls: {
+        "RABBITMQ_HOST": RABBITMQ_HOST,
+        "TASK_TYPES": '{"bench": {}}',
+    }),
+]}
+
+# Ports published by docker-compose.yml
+COMPOSE_URLS = {
+    "api": "http://localhost:8000",
+    "addition": "http://localhost:8001",
+    "subtraction": "http://localhost:8002",
+    "file_splitter": "http://localhost:8010",
+    "file_hasher": "http://localhost:8011",
+    "proxy_pusher": "http://localhost:9100",
+    "addition_popper": "http://localhost:9001",
+    "subtraction_popper": "http://localhost:9002",
+}
+
+def wait_until_up(url: str, timeout: float = STARTUP_TIMEOUT, process: Optional[subprocess.Popen] = None) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with {process.returncode} during startup")
+        try:
+            if httpx.get(f"{url}/openapi.json", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up within {timeout}s")
+
+class LocalStack:
+    # Runs each service as its own uvicorn process, the way compose does, so
+    # every service gets its own event loop and its memory can be measured
+    def __init__(self, names: list[str]):
+        self.names = names
+        self.urls = {name: f"http://{LOCAL_HOST}:{LOCAL_BASE_PORT + i}" for i, name in enumerate(names)}
+        self.processes: dict[str, subprocess.Popen] = {}
+
+    def __enter__(self):
+        try:
+            for name in self.names:
+                self._start(SERVICES[name])
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _start(self, service: Service) -> None:
+        port = self.urls[service.name].rsplit(":", 1)[1]
+        env = {**os.environ, "PYTHONUNBUFFERED": "1", "REDIS_URL": REDIS_URL, "BLOB_DIR": BLOB_DIR, **service.env(self.urls)}
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", LOCAL_HOST, "--port", port, "--log-level", "warning"],
+            cwd=os.path.join(SUBPROJECTS, service.subproject),
+            env=env,
+        )
+        self.processes[service.name] = process
+        wait_until_up(self.urls[service.name], process=process)
+
+    def peak_rss_mb(self) -> dict[str, float]:
+        # VmHWM is the kernel's high-water mark of the process's resident memory
+        peaks = {}
+        for name, process in self.processes.items():
+            try:
+                with open(f"/proc/{process.pid}/status") as f:
+                    match = re.search(r"VmHWM:\s+(\d+) kB", f.read())
+            except OSError:
+                continue
+            if match:
+                peaks[name] = round(int(match.group(1)) / 1024, 1)
+        return peaks
+
+    def stop(self) -> None:
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+def parse_size(value: str) -> int:
+    # Sizes are binary throughout, as docker stats reports them: KB and KiB
+    # are both 1024 bytes, MB/MiB 1024 ** 2 and GB/GiB 1024 ** 3
+    match = re.fullmatch(r"([\d.]+)\s*([KMG]?)I?B?", value.strip().upper())
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * 1024 ** " KMG".index(match.group(2) or " "))
+
+class ComposeStack:
+    # The running docker-compose stack; memory is sampled with `docker stats`
+    def __init__(self, names: list[str], interval: float = 1.0):
+        self.names = names
+        self.interval = interval
+        self.urls = dict(COMPOSE_URLS)
+        self.peaks: dict[str, float] = {}
+
+    def __enter__(self):
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            try:
+                output = subprocess.run(
+                    ["docker", "stats", "--no-stream", "--format", "{{.Name}}\t{{.MemUsage}}", *self.names],
+                    capture_output=True, text=True, timeout=30,
+                ).stdout
+            except (OSError, subprocess.TimeoutExpired):
+                return
+            for line in output.splitlines():
+                name, _, usage = line.partition("\t")
+                try:
+                    used = parse_size(usage.split("/")[0]) / 1024 ** 2
+                except ValueError:
+                    continue
+                self.peaks[name] = max(self.peaks.get(name, 0.0), round(used, 1))
+            self._stop.wait(self.interval)
+
+    def peak_rss_mb(self) -> dict[str, float]:
+        return dict(self.peaks)
@@ -1,4 +1,4 @@
-from shared.api import get_app
+from shared.api import add_batch_route, get_app
 from shared.interfaces import AdditionRequest, AdditionResponse
 
 app = get_app()
@@ -6,4 +6,6 @@ app = get_app()
 @app.post("/add")
 def add_numbers(request: AdditionRequest) -> AdditionResponse:
     result = request.a + request.b
-    return AdditionResponse(result=result) 
\ No newline at end of file
+    return AdditionResponse(result=result)
+
+add_batch_route(app, "/add/batch", add_numbers)
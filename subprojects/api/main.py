@@ -1,95 +1,246 @@
-from typing import Type
-from fastapi import File, UploadFile
+from typing import Any, AsyncIterator, Type
+from fastapi import File, Query, Request, UploadFile
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-import httpx
 import random
+import json
 import os
-import io
 import tarfile
 import asyncio
 from shared.api import get_app
-from shared.interfaces import SubtractionRequest, SubtractionResponse, AdditionRequest, AdditionResponse, WaitRequest, WaitResponse
+from shared.blobs import BLOB_TTL, blob_store
+from shared.clients import http_clients
+from shared.memo import memo, memoizable
+from shared.tracing import SERIALIZATION, timed
+from shared.interfaces import AdditionRequest, HashRefRequest, SubtractionRequest, WaitRequest, WaitResponse
+from workflow import HttpExecutor, JobBrokerExecutor, Workflow, WorkflowError, run_workflow
 
 app = get_app()
 
 class CalculateRequest(BaseModel):
     x: float
 
+class HashRefResponse(BaseModel):
+    sha256: str
+
 ADDITION_URL = os.getenv("ADDITION_URL", "http://addition:8000/add")
 SUBTRACTION_URL = os.getenv("SUBTRACTION_URL", "http://subtraction:8000/subtract")
 FILE_SPLITTER_URL = os.getenv("FILE_SPLITTER_URL", "http://file_splitter:8000/split")
 FILE_HASHER_URL = os.getenv("FILE_HASHER_URL", "http://file_hasher:8000/hash")
+FILE_HASHER_TREE_URL = os.getenv("FILE_HASHER_TREE_URL", f"{FILE_HASHER_URL}/tree")
+FILE_SPLITTER_REF_URL = os.getenv("FILE_SPLITTER_REF_URL", f"{FILE_SPLITTER_URL}/ref")
+FILE_HASHER_REF_URL = os.getenv("FILE_HASHER_REF_URL", f"{FILE_HASHER_URL}/ref")
+FILE_HASHER_TREE_REF_URL = os.getenv("FILE_HASHER_TREE_REF_URL", f"{FILE_HASHER_TREE_URL}/ref")
 WAIT_URL = os.getenv("WAIT_URL", "http://wait:8000/wait")
+SPLIT_HASH_CONCURRENCY = int(os.getenv("SPLIT_HASH_CONCURRENCY", 8))  # parts hashed at once
+JOB_BROKER_URL = os.getenv("JOB_BROKER_URL", "http://job_broker:8000")
+WORKFLOW_CONCURRENCY = int(os.getenv("WORKFLOW_CONCURRENCY", 16))  # step calls in flight per workflow run
+WORKFLOW_TASK_WAIT = float(os.getenv("WORKFLOW_TASK_WAIT", 30))  # seconds per long-poll for a job_broker step
+# Extra HTTP targets workflows may call, as a JSON object of name -> URL
+WORKFLOW_TARGETS = os.getenv("WORKFLOW_TARGETS", "")
+
+workflow_executors = {
+    "http": HttpExecutor({
+        "addition": ADDITION_URL,
+        "subtraction": SUBTRACTION_URL,
+        "wait": WAIT_URL,
+        **json.loads(WORKFLOW_TARGETS or "{}"),
+    }, {
+        "addition": AdditionRequest,
+        "subtraction": SubtractionRequest,
+    }),
+    "job_broker": JobBrokerExecutor(JOB_BROKER_URL, WORKFLOW_TASK_WAIT),
+}
 
 async def _call_endpoint(url: str, request: BaseModel, response_type: Type[BaseModel]) -> BaseModel:
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, json=request.model_dump(), timeout=60)
-        resp.raise_for_status()
-        return response_type.model_validate(resp.json())
+    with timed(SERIALIZATION, "encode"):
+        body = request.model_dump_json()
 
-async def call_addition(a: float, b: float) -> float:
-    r: AdditionResponse = await _call_endpoint(ADDITION_URL, AdditionRequest(a=a, b=b), AdditionResponse)
-    return r.result
+    async def post():
+        resp = await http_clients.request("POST", url, content=body, headers={"Content-Type": "application/json"}, timeout=60)
+        resp.raise_for_status()
+        return resp.content
 
-async def call_subtraction(a: float, b: float) -> float:
-    r: SubtractionResponse = await _call_endpoint(SUBTRACTION_URL, SubtractionRequest(a=a, b=b), SubtractionResponse)
-    return r.result
+    # Pure calls are answered from the memo, or share an identical call in flight
+    content = await (memo.call(url, body.encode(), post) if memoizable(type(request)) else post())
+    with timed(SERIALIZATION, "decode"):
+        return response_type.model_validate_json(content)
 
 async def call_wait(wait_time: float) -> float:
     r: WaitResponse = await _call_endpoint(WAIT_URL, WaitRequest(wait_time=wait_time), WaitResponse)
     return r
 
+@app.exception_handler(WorkflowError)
+async def workflow_failed(request: Request, error: WorkflowError):
+    return JSONResponse(status_code=502, content={"error": error.message, "step": error.step})
+
+CALCULATE = Workflow.model_validate({
+    "steps": [
+        {"name": "add", "call": "addition", "input": {"a": "$input.x", "b": "$input.add_rand"}},
+        {"name": "subtract", "call": "subtraction", "input": {"a": "$steps.add.result", "b": "$input.sub_rand"}},
+    ],
+    "output": "$steps.subtract.result",
+})
+
 @app.post("/calculate")
 async def calculate(request: CalculateRequest):
     x = request.x
     add_rand = random.uniform(1, 10)
     sub_rand = random.uniform(1, 10)
-    
-    added: float = await call_addition(a=x, b=add_rand)
-    subtracted: float = await call_subtraction(a=added, b=sub_rand)
-    
+
+    run = await run_workflow(CALCULATE, {"x": x, "add_rand": add_rand, "sub_rand": sub_rand},
+                             workflow_executors, WORKFLOW_CONCURRENCY)
+
     return {
         "initial": x,
         "added_random": add_rand,
         "subtracted_random": sub_rand,
-        "result": subtracted
+        "result": run["output"]
     }
 
+class WorkflowRequest(BaseModel):
+    workflow: Workflow
+    input: Any = None
+
+@app.post("/workflow")
+async def workflow(request: WorkflowRequest):
+    # Runs a workflow given in the request; see workflow.py for the format
+    return await run_workflow(request.workflow, request.input, workflow_executors, WORKFLOW_CONCURRENCY)
+
 @app.post("/wait")
 async def wait(request: WaitRequest):
     wr: WaitResponse = await call_wait(request.wait_time)
     return wr
 
+class TarStreamReader:
+    # Reads fixed-size records from an async byte stream without buffering it all
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self.chunks = chunks.__aiter__()
+        self.buffer = bytearray()
+
+    async def read_exactly(self, n: int) -> bytes:
+        while len(self.buffer) < n:
+            try:
+                self.buffer += await self.chunks.__anext__()
+            except StopAsyncIteration:
+                raise tarfile.ReadError("Unexpected end of tar stream")
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def members(self) -> AsyncIterator[bytes]:
+        # Yields the contents of each regular file, in archive order
+        while True:
+            block = await self.read_exactly(tarfile.BLOCKSIZE)
+            try:
+                info = tarfile.TarInfo.frombuf(block, tarfile.ENCODING, "surrogateescape")
+            except tarfile.EOFHeaderError:
+                return
+            padded = info.size + -info.size % tarfile.BLOCKSIZE
+            if not info.isreg():
+                # pax/GNU extension headers and directories carry no part data
+                await self.read_exactly(padded)
+                continue
+            data = await self.read_exactly(padded)
+            yield data[:info.size]
+
+async def tree_hash(file: UploadFile, chunk_size: int):
+    # One upload to file_hasher, which hashes the chunks locally and also
+    # returns their Merkle root
+    files = {"file": (file.filename, file.file, file.content_type)}
+    resp = await http_clients.request("POST", FILE_HASHER_TREE_URL, files=files, data={"chunk_size": str(chunk_size)})
+    resp.raise_for_status()
+    tree = resp.json()
+    return {"result": tree["chunks"], "root": tree["root"], "size": tree["size"], "chunk_size": chunk_size}
+
+async def blob_split_hash(file: UploadFile, mode: str, chunk_size: int):
+    # The upload is stored once in the shared blob store; file_splitter and
+    # file_hasher get references to it (and to byte ranges of it) instead of
+    # the bytes, and hash straight from the mapped file
+    ref = str(await asyncio.to_thread(blob_store.put_file, file.file))
+    if mode == "tree":
+        resp = await http_clients.request("POST", FILE_HASHER_TREE_REF_URL, json={"ref": ref, "chunk_size": chunk_size})
+        resp.raise_for_status()
+        tree = resp.json()
+        return {"result": tree["chunks"], "root": tree["root"], "size": tree["size"], "chunk_size": chunk_size}
+
+    resp = await http_clients.request("POST", FILE_SPLITTER_REF_URL, json={"ref": ref, "size": chunk_size})
+    resp.raise_for_status()
+    in_flight = asyncio.Semaphore(SPLIT_HASH_CONCURRENCY)
+
+    async def hash_part(part_ref):
+        async with in_flight:
+            resp = await _call_endpoint(FILE_HASHER_REF_URL, HashRefRequest(ref=part_ref), HashRefResponse)
+            return resp.sha256
+
+    return {"result": await asyncio.gather(*(hash_part(part) for part in resp.json()["parts"]))}
+
 @app.post("/split-hash")
-async def split_and_hash(file: UploadFile = File(...)):
-    # Step 1: Call file_splitter to split into 10MB chunks
-    ten_mb = 1 * 1024 * 1024
+async def split_and_hash(
+    file: UploadFile = File(...),
+    mode: str = Query("parts", pattern="^(parts|tree)$"),
+    chunk_size: int = Query(1024 * 1024, gt=0),
+    transport: str = Query("http", pattern="^(http|blob)$"),
+):
     file.file.seek(0)
+    if transport == "blob":
+        return await blob_split_hash(file, mode, chunk_size)
+    if mode == "tree":
+        return await tree_hash(file, chunk_size)
+
+    # Step 1: Call file_splitter to split into chunk_size parts
     files = {"file": (file.filename, file.file, file.content_type)}
-    data = {"size": str(ten_mb)}
-    async with httpx.AsyncClient() as client:
-        response = await client.post(FILE_SPLITTER_URL, files=files, data=data)
-        response.raise_for_status()
-        tar_bytes = response.content
+    data = {"size": str(chunk_size)}
 
-    # Step 2: Untar the result
-    tar_stream = io.BytesIO(tar_bytes)
-    hashes = []
     async def hash_part(part_bytes):
-        files = {"file": ("chunk", part_bytes)}
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(FILE_HASHER_URL, files=files)
+        try:
+            files = {"file": ("chunk", part_bytes)}
+            resp = await http_clients.request("POST", FILE_HASHER_URL, files=files)
             resp.raise_for_status()
             return resp.json()["sha256"]
-    with tarfile.open(fileobj=tar_stream, mode="r") as tar:
-        tasks = []
-        for member in tar.getmembers():
-            f = tar.extractfile(member)
-            if f:
-                part_bytes = f.read()
-                tasks.append(hash_part(part_bytes))
-        hashes = await asyncio.gather(*tasks)
-    return {"result": hashes} 
+        finally:
+            in_flight.release()
+
+    # Step 2: Untar the result as it streams in and hash each part as soon as
+    # it is complete. The semaphore is taken before a part is read, so at most
+    # SPLIT_HASH_CONCURRENCY parts are held in memory or being hashed.
+    in_flight = asyncio.Semaphore(SPLIT_HASH_CONCURRENCY)
+    async with http_clients.stream("POST", FILE_SPLITTER_URL, files=files, data=data) as response:
+        response.raise_for_status()
+        async with asyncio.TaskGroup() as group:
+            tasks = []
+            members = TarStreamReader(response.aiter_bytes()).members()
+            while True:
+                await in_flight.acquire()
+                try:
+                    part_bytes = await anext(members)
+                except StopAsyncIteration:
+                    in_flight.release()
+                    break
+                tasks.append(group.create_task(hash_part(part_bytes)))
+    return {"result": [task.result() for task in tasks]}
+
+async def prune_blobs():
+    while True:
+        await asyncio.sleep(BLOB_TTL / 4)
+        try:
+            removed = await asyncio.to_thread(blob_store.prune)
+            if removed:
+                print(f"Pruned {removed} blobs")
+        except Exception as e:
+            print(f"Blob pruning failed: {e!r}")
+
+background_tasks = []
+
+@app.on_event("startup")
+async def start_blob_pruning():
+    background_tasks.append(asyncio.create_task(prune_blobs()))
+
+@app.on_event("shutdown")
+async def stop_blob_pruning():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
 
 if __name__ == "__main__":
     import uvicorn
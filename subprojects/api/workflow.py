@@ -0,0 +1,251 @@
+from typing import Any, Awaitable, Callable, Iterator, Literal, Optional
+from pydantic import BaseModel, Field, ValidationError, model_validator
+import asyncio
+import json
+import re
+import time
+from shared.clients import http_clients
+from shared.memo import memo, memoizable
+from shared.tracing import SERIALIZATION, span, timed
+
+# A workflow is a set of steps, each one call to a service. Step inputs are
+# templates: any string of the form "$input.x", "$steps.<name>.field" or
+# "$item.field" is replaced by that value, which also makes the step depend
+# on the referenced one. Steps whose dependencies are done run concurrently,
+# so a workflow takes as long as its critical path.
+#
+# {
+#   "steps": [
+#     {"name": "add", "call": "addition", "input": {"a": "$input.x", "b": 1}},
+#     {"name": "sub", "call": "subtraction", "input": {"a": "$input.x", "b": 2}},
+#     {"name": "sum", "call": "addition", "input": {"a": "$steps.add.result", "b": "$steps.sub.result"}}
+#   ],
+#   "output": "$steps.sum.result"
+# }
+#
+# A step with "foreach" runs once per item of the referenced list (fan-out),
+# with "$item" bound to the item; its output is the list of results, which a
+# later step can take as a whole (fan-in).
+
+REFERENCE = re.compile(r"\$(input|steps|item)((?:\.[^.]+)*)")
+
+class Step(BaseModel):
+    name: str = Field(pattern=r"^[A-Za-z_][A-Za-z0-9_-]*$")
+    call: str  # an HTTP target name, or a job_broker task type
+    via: Literal["http", "job_broker"] = "http"
+    input: Any = None
+    foreach: Optional[str] = None  # reference to a list
+    after: list[str] = []  # dependencies not already implied by references
+
+class Workflow(BaseModel):
+    steps: list[Step] = Field(min_length=1)
+    output: Any = None  # template; all step outputs by name if unset
+
+    @model_validator(mode="after")
+    def check_graph(self):
+        topological_order(self)
+        return self
+
+class WorkflowError(Exception):
+    def __init__(self, step: str, message: str):
+        super().__init__(f"Step {step} failed: {message}")
+        self.step = step
+        self.message = message
+
+def references(template: Any) -> Iterator[tuple[str, list[str]]]:
+    # (root, path) of every reference in a template
+    if isinstance(template, str):
+        match = REFERENCE.fullmatch(template)
+        if match:
+            yield match.group(1), [part for part in match.group(2).split(".") if part]
+    elif isinstance(template, dict):
+        for value in template.values():
+            yield from references(value)
+    elif isinstance(template, list):
+        for value in template:
+            yield from references(value)
+
+def dependencies(step: Step) -> set[str]:
+    needed = set(step.after)
+    for root, path in references([step.input, step.foreach]):
+        if root == "steps":
+            if not path:
+                raise ValueError(f"Step {step.name} references $steps without a step name")
+            needed.add(path[0])
+    return needed
+
+def topological_order(workflow: Workflow) -> list[Step]:
+    # Raises ValueError for duplicate or unknown steps and for cycles
+    steps = {}
+    for step in workflow.steps:
+        if step.name in steps:
+            raise ValueError(f"Duplicate step {step.name}")
+        if step.foreach is not None and not REFERENCE.fullmatch(step.foreach):
+            raise ValueError(f"Step {step.name}: foreach must be a reference")
+        steps[step.name] = step
+    for step in workflow.steps:
+        for root, _ in references(step.input):
+            if root == "item" and step.foreach is None:
+                raise ValueError(f"Step {step.name} uses $item without foreach")
+    pending = {name: dependencies(step) for name, step in steps.items()}
+    for name, needed in pending.items():
+        unknown = needed - steps.keys()
+        if unknown:
+            raise ValueError(f"Step {name} depends on unknown steps: {', '.join(sorted(unknown))}")
+    for root, path in references(workflow.output):
+        if root == "steps" and (not path or path[0] not in steps):
+            raise ValueError("Workflow output references an unknown step")
+    order = []
+    done = set()
+    while pending:
+        ready = [name for name, needed in pending.items() if needed <= done]
+        if not ready:
+            raise ValueError(f"Dependency cycle between steps: {', '.join(sorted(pending))}")
+        for name in ready:
+            order.append(steps[name])
+            done.add(name)
+            del pending[name]
+    return order
+
+def lookup(value: Any, path: list[str]) -> Any:
+    for part in path:
+        if isinstance(value, list):
+            value = value[int(part)]
+        else:
+            value = value[part]
+    return value
+
+def resolve(template: Any, scope: dict) -> Any:
+    if isinstance(template, str):
+        match = REFERENCE.fullmatch(template)
+        if match is None:
+            return template
+        root, path = match.group(1), [part for part in match.group(2).split(".") if part]
+        try:
+            return lookup(scope[root], path)
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise ValueError(f"Cannot resolve {template}")
+    if isinstance(template, dict):
+        return {key: resolve(value, scope) for key, value in template.items()}
+    if isinstance(template, list):
+        return [resolve(value, scope) for value in template]
+    return template
+
+# --- Executors ---
+# An executor takes the step's `call` and its resolved input and returns its output
+Executor = Callable[[str, Any], Awaitable[Any]]
+
+class HttpExecutor:
+    # POSTs the input as JSON to a named target; only configured targets can
+    # be called, so a submitted workflow can't reach arbitrary hosts. Targets
+    # with a memoizable request model in `interfaces` go through the memo,
+    # keyed on the input as that model serializes it.
+    def __init__(self, targets: dict[str, str], interfaces: Optional[dict[str, type[BaseModel]]] = None):
+        self.targets = targets
+        self.interfaces = interfaces or {}
+
+    async def __call__(self, target: str, payload: Any) -> Any:
+        url = self.targets.get(target)
+        if url is None:
+            raise ValueError(f"Unknown target {target}")
+        interface = self.interfaces.get(target)
+        with timed(SERIALIZATION, "encode"):
+            if memoizable(interface):
+                try:
+                    body = interface.model_validate(payload).model_dump_json()
+                except ValidationError:
+                    body, interface = json.dumps(payload), None  # the target reports what's wrong
+            else:
+                body = json.dumps(payload)
+
+        async def post():
+            resp = await http_clients.request("POST", url, content=body, headers={"Content-Type": "application/json"})
+            resp.raise_for_status()
+            return resp.content
+
+        content = await (memo.call(url, body.encode(), post) if memoizable(interface) else post())
+        with timed(SERIALIZATION, "decode"):
+            return json.loads(content)
+
+class JobBrokerExecutor:
+    # Submits the input as a task of type `call` and long-polls for its result
+    def __init__(self, base_url: str, wait: float):
+        self.base_url = base_url.rstrip("/")
+        self.wait = wait
+
+    async def __call__(self, task_type: str, payload: Any) -> Any:
+        resp = await http_clients.request("POST", f"{self.base_url}/submit/{task_type}", json={"payload": payload})
+        resp.raise_for_status()
+        task_id = resp.json()["task_id"]
+        while True:
+            resp = await http_clients.request("GET", f"{self.base_url}/result/{task_type}/{task_id}",
+                                              params={"wait": self.wait}, timeout=self.wait + 10)
+            if resp.status_code == 200:
+                return resp.json()["result"]
+            if resp.status_code != 404:
+                resp.raise_for_status()
+            # Not completed yet, or never will be
+            resp = await http_clients.request("GET", f"{self.base_url}/status/{task_type}/{task_id}")
+            resp.raise_for_status()
+            state = resp.json()["state"]
+            if state not in ("queued", "processing"):
+                raise RuntimeError(f"Task {task_id} is {state}")
+
+# --- Scheduler ---
+async def run_workflow(workflow: Workflow, inputs: Any, executors: dict[str, Executor], concurrency: int) -> dict:
+    # Runs every step as soon as its dependencies are done, with at most
+    # `concurrency` calls in flight. Identical calls (same executor, target
+    # and input) within a run are made once. The first failure cancels the
+    # rest of the run and is raised as a WorkflowError.
+    limit = asyncio.Semaphore(concurrency)
+    outputs: dict[str, Any] = {}
+    timings: dict[str, float] = {}
+    calls: dict[tuple, asyncio.Task] = {}
+    tasks: dict[str, asyncio.Task] = {}
+
+    async def limited(step: Step, payload: Any) -> Any:
+        async with limit:
+            return await executors[step.via](step.call, payload)
+
+    async def call(step: Step, payload: Any) -> Any:
+        # Outside the task group, so its failure reaches the step (which
+        # names itself in the error) rather than the group
+        key = (step.via, step.call, json.dumps(payload, sort_keys=True))
+        if key not in calls:
+            calls[key] = asyncio.ensure_future(limited(step, payload))
+        return await asyncio.shield(calls[key])
+
+    async def execute(step: Step) -> None:
+        await asyncio.gather(*(tasks[name] for name in dependencies(step)))
+        started = time.perf_counter()
+        try:
+            with span(f"step {step.name}", step=step.name, via=step.via, call=step.call):
+                if step.foreach is None:
+                    output = await call(step, resolve(step.input, {"input": inputs, "steps": outputs}))
+                else:
+                    items = resolve(step.foreach, {"input": inputs, "steps": outputs})
+                    if not isinstance(items, list):
+                        raise ValueError("foreach does not reference a list")
+                    output = list(await asyncio.gather(*(
+                        call(step, resolve(step.input, {"input": inputs, "steps": outputs, "item": item}))
+                        for item in items
+                    )))
+        except Exception as e:
+            raise WorkflowError(step.name, str(e) or repr(e)) from e
+        outputs[step.name] = output
+        timings[step.name] = round((time.perf_counter() - started) * 1000, 3)
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            for step in topological_order(workflow):
+                tasks[step.name] = group.create_task(execute(step))
+    except ExceptionGroup as e:
+        raise e.exceptions[0]
+    finally:
+        for pending in calls.values():
+            pending.cancel()
+    if workflow.output is None:
+        output = outputs
+    else:
+        output = resolve(workflow.output, {"input": inputs, "steps": outputs})
+    return {"output": output, "timings_ms": timings}
@@ -0,0 +1,90 @@
+from typing import AsyncIterator, Optional
+import asyncio
+import numpy as np
+
+SAMPLE_RATE = 16000  # what the model expects
+DECODE_READ_SIZE = 64 * 1024  # bytes of PCM read from ffmpeg at a time
+
+class DecodeError(Exception):
+    pass
+
+async def decode_audio(chunks: AsyncIterator[bytes]) -> AsyncIterator[np.ndarray]:
+    # Pipes the encoded upload through ffmpeg and yields 16 kHz mono float32
+    # samples as they are decoded, without touching the disk. Containers that
+    # need seeking (e.g. MP4 with its index at the end) can't be read this way.
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-loglevel", "error", "-i", "pipe:0",
+        "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def feed():
+        try:
+            async for chunk in chunks:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg gave up; its exit code says why
+        finally:
+            proc.stdin.close()
+
+    feeder = asyncio.create_task(feed())
+    stderr = asyncio.create_task(proc.stderr.read())
+    try:
+        leftover = b""
+        while data := await proc.stdout.read(DECODE_READ_SIZE):
+            data = leftover + data
+            usable = len(data) - len(data) % 4
+            leftover = data[usable:]
+            if usable:
+                yield np.frombuffer(data[:usable], dtype=np.float32)
+        await feeder
+        if await proc.wait() != 0:
+            raise DecodeError((await stderr).decode(errors="replace").strip() or "Could not decode audio")
+    finally:
+        feeder.cancel()
+        stderr.cancel()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+async def windows(samples: AsyncIterator[np.ndarray], seconds: float, overlap: float) -> AsyncIterator[tuple[float, np.ndarray, bool]]:
+    # Yields (start seconds, samples, is_last) for windows of `seconds` that
+    # overlap the previous one by `overlap`. One window is held back so the
+    # last one can be flagged; a tail shorter than the overlap is already
+    # covered by the window before it.
+    size = int(seconds * SAMPLE_RATE)
+    step = size - int(overlap * SAMPLE_RATE)
+    buffer = np.empty(0, dtype=np.float32)
+    offset = 0
+    held: Optional[tuple[float, np.ndarray]] = None
+    async for block in samples:
+        buffer = np.concatenate((buffer, block))
+        while len(buffer) >= size:
+            if held is not None:
+                yield held[0], held[1], False
+            held = (offset / SAMPLE_RATE, buffer[:size])
+            buffer = buffer[step:]
+            offset += step
+    if held is None or len(buffer) > size - step:
+        if held is not None:
+            yield held[0], held[1], False
+        held = (offset / SAMPLE_RATE, buffer)
+    if len(held[1]):
+        yield held[0], held[1], True
+
+def window_words(words: list[dict], start: float, duration: float, overlap: float, last: bool) -> list[dict]:
+    # Words of one window on the recording's timeline. Where windows overlap,
+    # each keeps the words whose midpoint falls in its half of the overlap,
+    # so no word is dropped or repeated.
+    keep_from = start + overlap / 2 if start > 0 else float("-inf")
+    keep_to = float("inf") if last else start + duration - overlap / 2
+    kept = []
+    for word in words:
+        word_start = start + word["start"]
+        word_end = start + word["end"]
+        if keep_from <= (word_start + word_end) / 2 < keep_to:
+            kept.append({"word": word["word"], "start": round(word_start, 3), "end": round(word_end, 3)})
+    return kept
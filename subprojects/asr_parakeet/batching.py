@@ -0,0 +1,103 @@
+from typing import Any, Callable
+import asyncio
+import queue
+import threading
+import time
+from prometheus_client import Gauge, Histogram
+
+QUEUE_DEPTH = Gauge("batch_queue_depth", "Items waiting for a batch", ["batcher"])
+BATCH_SIZE = Histogram("batch_size", "Items per batch", ["batcher"], buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_SECONDS = Histogram("batch_seconds", "Time spent running a batch", ["batcher"])
+
+class BatchWorker:
+    # Collects items submitted from the event loop into batches of up to
+    # max_size, waiting at most max_wait seconds after the first one, and runs
+    # fn over each batch on a dedicated thread so the event loop never blocks.
+    # fn gets a list of items and returns a list of results in the same order.
+    def __init__(self, name: str, fn: Callable[[list], list], max_size: int, max_wait: float, max_queued: int = 0):
+        self.name = name
+        self.fn = fn
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue(max_queued)  # 0 means unbounded
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, name=f"batch-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+
+    def full(self) -> bool:
+        return self.queue.full()
+
+    async def submit(self, item: Any) -> Any:
+        # Raises queue.Full when max_queued items are already waiting
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put_nowait((item, future, loop))
+        QUEUE_DEPTH.labels(self.name).set(self.queue.qsize())
+        return await future
+
+    def _collect(self, first) -> tuple[list, bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch, stopping = self._collect(first)
+            QUEUE_DEPTH.labels(self.name).set(self.queue.qsize())
+            # Callers that gave up (disconnected clients) are left out
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                continue
+            BATCH_SIZE.labels(self.name).observe(len(batch))
+            started = time.perf_counter()
+            self._execute(batch)
+            BATCH_SECONDS.labels(self.name).observe(time.perf_counter() - started)
+
+    def _execute(self, batch: list) -> None:
+        try:
+            results = self.fn([item for item, _, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                _, future, loop = batch[0]
+                loop.call_soon_threadsafe(_resolve, future, None, e)
+                return
+            # One bad item (e.g. empty audio) fails the whole call; run the
+            # items one by one so only that one fails
+            print(f"Batch of {len(batch)} failed in {self.name}, retrying items one by one: {e!r}")
+            for entry in batch:
+                self._execute([entry])
+            return
+        for (_, future, loop), result in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve, future, result, None)
+        if len(results) < len(batch):
+            error = RuntimeError(f"{self.name} returned {len(results)} results for {len(batch)} items")
+            for _, future, loop in batch[len(results):]:
+                loop.call_soon_threadsafe(_resolve, future, None, error)
+
+def _resolve(future: asyncio.Future, result: Any, error: Exception) -> None:
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
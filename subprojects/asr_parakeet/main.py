@@ -1,39 +1,163 @@
 from functools import lru_cache
-from fastapi import File, UploadFile
+from collections import deque
+from typing import AsyncIterator
+from fastapi import File, Query, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 import nemo.collections.asr as nemo_asr
+import numpy as np
+import asyncio
+import torch
 import tempfile
 import shutil
+import queue
+import json
 import os
-from shared.api import get_app
+from shared.api import RequestStreamingResponse, get_app
+from shared.notify import sse_event
+from audio import SAMPLE_RATE, DecodeError, decode_audio, window_words, windows
+from batching import BatchWorker
 
 app = get_app()
 
+ASR_DEVICE = os.getenv("ASR_DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
+ASR_THREADS = int(os.getenv("ASR_THREADS", 0))  # torch CPU threads, 0 keeps torch's default
+ASR_BATCH_SIZE = int(os.getenv("ASR_BATCH_SIZE", 8))  # files per transcribe call
+ASR_BATCH_WAIT_MS = float(os.getenv("ASR_BATCH_WAIT_MS", 50))  # how long a batch waits to fill up
+ASR_MAX_QUEUED = int(os.getenv("ASR_MAX_QUEUED", 256))  # files waiting before we answer 429
+ASR_WINDOW_SECONDS = float(os.getenv("ASR_WINDOW_SECONDS", 30))  # audio per streamed segment
+ASR_WINDOW_OVERLAP = float(os.getenv("ASR_WINDOW_OVERLAP", 2))  # seconds shared by neighbouring segments
+# Segments of one stream being transcribed at once; the rest of the upload
+# waits, so a long recording can't fill the whole queue
+ASR_STREAM_PARALLEL = int(os.getenv("ASR_STREAM_PARALLEL", ASR_BATCH_SIZE))
+
+if ASR_THREADS:
+    torch.set_num_threads(ASR_THREADS)
+
 # Load the model once at startup
 @lru_cache
 def load_model():
-    model = nemo_asr.models.ASRModel.from_pretrained(model_name="nvidia/parakeet-tdt-0.6b-v2")
+    model = nemo_asr.models.ASRModel.from_pretrained(model_name="nvidia/parakeet-tdt-0.6b-v2", map_location=ASR_DEVICE)
     # Handle long audio
     # https://huggingface.co/nvidia/parakeet-tdt-0.6b-v2/discussions/15
     # https://developer.nvidia.com/blog/pushing-the-boundaries-of-speech-recognition-with-nemo-parakeet-asr-models/#parakeet_models_for_long-form_speech_inference
     model.change_attention_model("rel_pos_local_attn", [128, 128])  # local attn
     model.change_subsampling_conv_chunking_factor(1)  # 1 = auto select
+    model.eval()
     return model
 
 asr_model = load_model()
 
-@app.post("/transcribe")
-async def transcribe_audio(file: UploadFile = File(...)):
-    # Save uploaded file to a temp file
+def transcribe_batch(audio: list[str | np.ndarray]) -> list[dict]:
+    # Runs on the batcher's thread. A batch can mix file paths (/transcribe)
+    # and decoded windows (/transcribe/stream); each kind gets one call.
+    results = [None] * len(audio)
+    with torch.inference_mode():
+        for is_path in (True, False):
+            indices = [i for i, item in enumerate(audio) if isinstance(item, str) == is_path]
+            if not indices:
+                continue
+            output = asr_model.transcribe([audio[i] for i in indices], batch_size=len(indices), timestamps=True)
+            for i, hypothesis in zip(indices, output):
+                results[i] = {"text": hypothesis.text, "words": hypothesis.timestamp["word"]}
+    return results
+
+batcher = BatchWorker(
+    "asr",
+    transcribe_batch,
+    max_size=ASR_BATCH_SIZE,
+    max_wait=ASR_BATCH_WAIT_MS / 1000,
+    max_queued=ASR_MAX_QUEUED,
+)
+
+def save_upload(file: UploadFile) -> str:
     with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[-1]) as tmp:
         shutil.copyfileobj(file.file, tmp)
-        tmp_path = tmp.name
+        return tmp.name
+
+@app.on_event("startup")
+async def start_batcher():
+    batcher.start()
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    await run_in_threadpool(batcher.stop)
+
+TOO_BUSY = {"error": "Too many queued transcriptions"}
+
+@app.post("/transcribe")
+async def transcribe_audio(file: UploadFile = File(...)):
+    if batcher.full():
+        return JSONResponse(TOO_BUSY, status_code=429, headers={"Retry-After": "1"})
+    # A seekable file rather than the pipe: containers with their index at the
+    # end (e.g. MP4) decode, and a queued request holds the upload on disk
+    # rather than its decoded samples in memory
+    tmp_path = await run_in_threadpool(save_upload, file)
     try:
-        output = asr_model.transcribe([tmp_path], timestamps=True)
-        text = output[0].text
+        result = await batcher.submit(tmp_path)
+    except queue.Full:
+        return JSONResponse(TOO_BUSY, status_code=429, headers={"Retry-After": "1"})
     finally:
         os.remove(tmp_path)
-    return JSONResponse({"text": text})
+    return JSONResponse({"text": result["text"]})
+
+async def transcribe_segments(chunks: AsyncIterator[bytes]) -> AsyncIterator[dict]:
+    # Cuts the audio into overlapping windows as it is decoded and transcribes
+    # them in parallel (they share batches with other requests), yielding each
+    # segment in order as soon as it and the ones before it are done
+    pending = deque()
+    try:
+        async for start, samples, last in windows(decode_audio(chunks), ASR_WINDOW_SECONDS, ASR_WINDOW_OVERLAP):
+            pending.append((start, len(samples) / SAMPLE_RATE, last, asyncio.ensure_future(batcher.submit(samples))))
+            while len(pending) >= ASR_STREAM_PARALLEL or (pending and pending[0][3].done()):
+                yield await segment(*pending.popleft())
+        while pending:
+            yield await segment(*pending.popleft())
+    finally:
+        for *_, task in pending:
+            task.cancel()
+
+async def segment(start: float, duration: float, last: bool, task: asyncio.Future) -> dict:
+    result = await task
+    words = window_words(result["words"], start, duration, ASR_WINDOW_OVERLAP, last)
+    return {
+        "start": round(start, 3),
+        "end": round(start + duration, 3),
+        "text": " ".join(word["word"] for word in words),
+        "words": words,
+    }
+
+@app.post("/transcribe/stream")
+async def transcribe_stream(request: Request, format: str = Query("ndjson", pattern="^(ndjson|sse)$")):
+    # Raw audio as the request body, decoded while it uploads. Segments are
+    # streamed as newline-delimited JSON (or server-sent events with
+    # format=sse), followed by a final record with the full text.
+    if batcher.full():
+        return JSONResponse(TOO_BUSY, status_code=429, headers={"Retry-After": "1"})
+
+    def encode(event: str, data: dict) -> str:
+        if format == "sse":
+            return sse_event(event, data)
+        return json.dumps({"event": event, **data}) + "\n"
+
+    async def events():
+        texts = []
+        try:
+            async for data in transcribe_segments(request.stream()):
+                yield encode("segment", {"index": len(texts), **data})
+                texts.append(data["text"])
+        except DecodeError as e:
+            yield encode("error", {"error": str(e)})
+            return
+        except queue.Full:
+            yield encode("error", TOO_BUSY)
+            return
+        yield encode("done", {"text": " ".join(text for text in texts if text)})
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    # Not StreamingResponse: its disconnect listener would take the audio
+    # body's messages off receive() while transcribe_segments reads them
+    return RequestStreamingResponse(events(), media_type=media_type, headers={"Cache-Control": "no-cache"})
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Optional
+import hashlib
+import os
+import threading
+
+HASH_READ_SIZE = int(os.getenv("HASH_READ_SIZE", 4 * 1024 * 1024))  # bytes per read
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 4))
+HASH_CACHE_SIZE = int(os.getenv("HASH_CACHE_SIZE", 1024))  # entries, 0 disables the cache
+HASH_MAX_CHUNK_SIZE = int(os.getenv("HASH_MAX_CHUNK_SIZE", 64 * 1024 * 1024))  # largest /hash/tree chunk_size
+
+# A cache hit is only returned once a digest of the full content matches the
+# one stored with it; the fingerprint alone (or a checksum like CRC32) can be
+# forged to pull another file's hashes out of the cache. SHA-256 is the
+# cheapest collision-resistant choice on CPUs with SHA extensions.
+CHECK_ALGORITHM = "sha256"
+
+# Rough cost of each algorithm per byte, relative to SHA-256 with SHA
+# extensions. A request that costs no more than the check is hashed directly:
+# a hit would save nothing and a miss would add the fingerprint reads.
+ALGORITHM_COST = {"md5": 2, "sha1": 1, "sha256": 1, "sha512": 2, "blake2b": 2, "blake2s": 3}
+
+SAMPLE_SIZE = 4096
+SUPPORTED_ALGORITHMS = {"md5", "sha1", "sha256", "sha512", "blake2b", "blake2s"}
+
+# hashlib releases the GIL while hashing large buffers, so threads give real
+# parallelism here without the pickling cost of a process pool
+executor = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="hasher")
+
+class HashCache:
+    # LRU map of content fingerprint -> (full-content check digest, {algorithm: hexdigest})
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: bytes) -> Optional[tuple[Optional[str], dict]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: bytes, check: Optional[str], digests: dict) -> None:
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == check:
+                digests = {**entry[1], **digests}
+            self.entries[key] = (check, digests)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+cache = HashCache(HASH_CACHE_SIZE)
+
+def parse_algorithms(value: str) -> list[str]:
+    algorithms = [a.strip().lower() for a in value.split(",") if a.strip()]
+    unknown = set(algorithms) - SUPPORTED_ALGORITHMS
+    if not algorithms or unknown:
+        raise ValueError(f"Unsupported algorithms: {', '.join(sorted(unknown)) or value!r}")
+    return list(dict.fromkeys(algorithms))
+
+def fingerprint(f: BinaryIO, size: int) -> bytes:
+    # Size plus samples from the start, middle and end of the content
+    sampler = hashlib.blake2b(size.to_bytes(8, "big"), digest_size=16)
+    for offset in (0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)):
+        f.seek(offset)
+        sampler.update(f.read(SAMPLE_SIZE))
+    f.seek(0)
+    return sampler.digest()
+
+def _read_chunks(f: BinaryIO) -> Iterable[bytes]:
+    return iter(lambda: f.read(HASH_READ_SIZE), b"")
+
+def content_check(f: BinaryIO) -> str:
+    hasher = hashlib.new(CHECK_ALGORITHM)
+    for chunk in _read_chunks(f):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _hash(f: BinaryIO, algorithms: Iterable[str]) -> dict:
+    # Every algorithm is fed from a single read pass
+    hashers = {name: hashlib.new(name) for name in algorithms}
+    for chunk in _read_chunks(f):
+        for hasher in hashers.values():
+            hasher.update(chunk)
+    return hashers
+
+def digest(f: BinaryIO, algorithms: list[str]) -> tuple[str, dict]:
+    # The requested digests plus the cache check, from the same pass
+    hashers = _hash(f, dict.fromkeys([*algorithms, CHECK_ALGORITHM]))
+    return hashers[CHECK_ALGORITHM].hexdigest(), {name: hashers[name].hexdigest() for name in algorithms}
+
+def hash_file(f: BinaryIO, algorithms: list[str]) -> dict:
+    # Blocking; run it on the executor
+    if cache.max_entries <= 0 or sum(ALGORITHM_COST[name] for name in algorithms) <= ALGORITHM_COST[CHECK_ALGORITHM]:
+        return {name: hasher.hexdigest() for name, hasher in _hash(f, algorithms).items()}
+    size = f.seek(0, os.SEEK_END)
+    key = fingerprint(f, size)
+    entry = cache.get(key)
+    if entry is not None and all(name in entry[1] for name in algorithms):
+        check, digests = entry
+        # One pass of the check digest instead of one of each requested algorithm
+        if content_check(f) == check:
+            return {name: digests[name] for name in algorithms}
+        f.seek(0)
+    check, digests = digest(f, algorithms)
+    cache.put(key, check, digests)
+    return digests
+
+def hash_view(view: memoryview, algorithms: list[str], key: Optional[bytes] = None) -> dict:
+    # Blocking; hashes a buffer (e.g. a mapped blob range) in HASH_READ_SIZE
+    # slices without copying it. `key` must identify the content exactly (a
+    # blob reference does), so a cache hit needs no verification.
+    if key is not None:
+        entry = cache.get(key)
+        if entry is not None and all(name in entry[1] for name in algorithms):
+            return {name: entry[1][name] for name in algorithms}
+    hashers = {name: hashlib.new(name) for name in algorithms}
+    for offset in range(0, len(view), HASH_READ_SIZE):
+        chunk = view[offset:offset + HASH_READ_SIZE]
+        for hasher in hashers.values():
+            hasher.update(chunk)
+        chunk.release()
+    digests = {name: hasher.hexdigest() for name, hasher in hashers.items()}
+    if key is not None:
+        cache.put(key, None, digests)
+    return digests
+
+def chunk_hash(data: bytes) -> str:
+    # Blocking; a Merkle leaf's SHA-256, hashed directly (a cache check
+    # would cost as much as the hash itself)
+    return hashlib.sha256(data).hexdigest()
+
+def merkle_root(leaves: list[str]) -> str:
+    # Binary tree over the chunk hashes; an odd node out is promoted to the
+    # next level as is. Leaves are sha256(0x00 || chunk hash) and interior
+    # nodes sha256(0x01 || left || right), so an interior node can't equal a
+    # leaf (e.g. of a chunk whose content is 0x01 || left || right).
+    if not leaves:
+        return hashlib.sha256(b"").hexdigest()
+    level = [hashlib.sha256(b"\x00" + bytes.fromhex(leaf)).digest() for leaf in leaves]
+    while len(level) > 1:
+        paired = [hashlib.sha256(b"\x01" + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0].hex()
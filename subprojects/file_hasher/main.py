@@ -1,13 +1,95 @@
 from shared.api import get_app
-from fastapi import File, UploadFile
-import hashlib
+from shared.blobs import BlobNotFound, blob_store, parse_ref
+from shared.interfaces import HashRefRequest
+from fastapi import File, Form, HTTPException, Query, UploadFile
+from pydantic import BaseModel, Field
+import asyncio
+import engine
 
 app = get_app()
 
+class TreeRefRequest(BaseModel):
+    ref: str
+    chunk_size: int = Field(1024 * 1024, gt=0, le=engine.HASH_MAX_CHUNK_SIZE)
+
 @app.post("/hash")
-async def hash_file(file: UploadFile = File(...)):
-    hasher = hashlib.sha256()
-    for chunk in iter(lambda: file.file.read(4096), b""):
-        hasher.update(chunk)
-    file.file.close()
-    return {"sha256": hasher.hexdigest()} 
\ No newline at end of file
+async def hash_file(file: UploadFile = File(...), algorithms: str = Query("sha256")):
+    try:
+        names = engine.parse_algorithms(algorithms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Hash off the event loop so large uploads don't stall other requests
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(engine.executor, engine.hash_file, file.file, names)
+    finally:
+        file.file.close()
+
+@app.post("/hash/tree")
+async def hash_tree(file: UploadFile = File(...), chunk_size: int = Form(1024 * 1024, gt=0, le=engine.HASH_MAX_CHUNK_SIZE)):
+    # Hash fixed-size chunks in parallel and combine them into a Merkle root
+    loop = asyncio.get_running_loop()
+    # Bound the chunks held in memory while waiting for a hashing thread
+    in_flight = asyncio.Semaphore(engine.HASH_WORKERS * 2)
+
+    async def hash_chunk(data):
+        try:
+            return await loop.run_in_executor(engine.executor, engine.chunk_hash, data)
+        finally:
+            in_flight.release()
+
+    size = 0
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = []
+            while True:
+                await in_flight.acquire()
+                data = await file.read(chunk_size)
+                if not data:
+                    in_flight.release()
+                    break
+                size += len(data)
+                tasks.append(group.create_task(hash_chunk(data)))
+    finally:
+        await file.close()
+    chunks = [task.result() for task in tasks]
+    return {"size": size, "chunk_size": chunk_size, "chunks": chunks, "root": engine.merkle_root(chunks)}
+
+def hash_ref(ref: str, algorithms: list[str]) -> dict:
+    # Blocking; the range is hashed straight from the mapped blob
+    blob = parse_ref(ref)
+    with blob_store.view(blob) as view:
+        return engine.hash_view(view, algorithms, key=str(blob).encode())
+
+def tree_ref(ref: str, chunk_size: int) -> dict:
+    blob = parse_ref(ref)
+    size = blob_store.size(blob)
+    chunks = [str(blob.slice(offset, min(chunk_size, size - offset))) for offset in range(0, size, chunk_size)]
+    return {"size": size, "chunks": chunks}
+
+async def run_blocking(fn, *args):
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(engine.executor, fn, *args)
+    except BlobNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Blob not found: {e}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/hash/ref")
+async def hash_blob(request: HashRefRequest, algorithms: str = Query("sha256")):
+    # Like /hash, for a blob in the shared store instead of an upload
+    try:
+        names = engine.parse_algorithms(algorithms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await run_blocking(hash_ref, request.ref, names)
+
+@app.post("/hash/tree/ref")
+async def hash_blob_tree(request: TreeRefRequest):
+    # Like /hash/tree, for a blob in the shared store; chunks are hashed in
+    # parallel, each from its own mapping of the range
+    tree = await run_blocking(tree_ref, request.ref, request.chunk_size)
+    chunks = await asyncio.gather(*(run_blocking(hash_ref, chunk, ["sha256"]) for chunk in tree["chunks"]))
+    chunks = [digests["sha256"] for digests in chunks]
+    return {"size": tree["size"], "chunk_size": request.chunk_size, "chunks": chunks, "root": engine.merkle_root(chunks)}
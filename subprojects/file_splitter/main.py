@@ -1,22 +1,102 @@
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, Query
 from fastapi.responses import StreamingResponse
-import io
+from pydantic import BaseModel, Field
+from collections import deque
+from typing import AsyncIterator
 import tarfile
-from shared.api import get_app
+from shared.api import RequestStreamingResponse, get_app
+from shared.blobs import BlobNotFound, blob_store, parse_ref
 
 app = get_app()
 
+READ_SIZE = 1024 * 1024  # bytes read from the upload at a time
+
+TAR_HEADERS = {"Content-Disposition": "attachment; filename=split_parts.tar"}
+
+def tar_header(name: str, size: int) -> bytes:
+    info = tarfile.TarInfo(name=name)
+    info.size = size
+    return info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape")
+
+def tar_padding(size: int) -> bytes:
+    return tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+def tar_trailer(written: int) -> bytes:
+    # Two empty blocks end the archive; tarfile then pads it to a full record
+    end = written + 2 * tarfile.BLOCKSIZE
+    return tarfile.NUL * (2 * tarfile.BLOCKSIZE + -end % tarfile.RECORDSIZE)
+
+async def split_to_tar(chunks: AsyncIterator[bytes], size: int) -> AsyncIterator[bytes]:
+    # Emits each part as soon as `size` bytes of it have arrived (only the last
+    # part can be shorter), so memory stays at one part plus one read. Parts are
+    # written as memoryview slices of the incoming chunks, without copying.
+    pending = deque()
+    pending_len = 0
+    parts = 0
+    written = 0
+
+    def emit(part_len):
+        nonlocal pending_len, parts, written
+        parts += 1
+        yield tar_header(f"part_{parts}", part_len)
+        remaining = part_len
+        while remaining:
+            view = pending[0]
+            if len(view) <= remaining:
+                pending.popleft()
+            else:
+                pending[0] = view[remaining:]
+                view = view[:remaining]
+            remaining -= len(view)
+            yield view
+        yield tar_padding(part_len)
+        pending_len -= part_len
+        written += tarfile.BLOCKSIZE + part_len + -part_len % tarfile.BLOCKSIZE
+
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        pending.append(memoryview(chunk))
+        pending_len += len(chunk)
+        while pending_len >= size:
+            for piece in emit(size):
+                yield piece
+    if pending_len:
+        for piece in emit(pending_len):
+            yield piece
+    yield tar_trailer(written)
+
+async def read_upload(file: UploadFile) -> AsyncIterator[bytes]:
+    try:
+        while chunk := await file.read(READ_SIZE):
+            yield chunk
+    finally:
+        await file.close()
+
 @app.post("/split")
-async def split_file(file: UploadFile = File(...), size: int = Form(...)):
-    # Read the file into memory
-    file_bytes = file.file.read()
-    parts = [file_bytes[i:i+size] for i in range(0, len(file_bytes), size)]
-
-    tar_stream = io.BytesIO()
-    with tarfile.open(fileobj=tar_stream, mode="w") as tar:
-        for idx, part in enumerate(parts):
-            info = tarfile.TarInfo(name=f"part_{idx+1}")
-            info.size = len(part)
-            tar.addfile(tarinfo=info, fileobj=io.BytesIO(part))
-    tar_stream.seek(0)
-    return StreamingResponse(tar_stream, media_type="application/x-tar", headers={"Content-Disposition": "attachment; filename=split_parts.tar"}) 
\ No newline at end of file
+async def split_file(file: UploadFile = File(...), size: int = Form(..., gt=0)):
+    return StreamingResponse(split_to_tar(read_upload(file), size), media_type="application/x-tar", headers=TAR_HEADERS)
+
+@app.post("/split/stream")
+async def split_stream(request: Request, size: int = Query(..., gt=0)):
+    # Raw request body instead of multipart: parts are split off while the
+    # upload is still arriving, so the first part reaches the client early
+    return RequestStreamingResponse(split_to_tar(request.stream(), size), media_type="application/x-tar", headers=TAR_HEADERS)
+
+class SplitRefRequest(BaseModel):
+    ref: str  # blob://sha256/<hex>, optionally with a range
+    size: int = Field(..., gt=0)
+
+@app.post("/split/ref")
+async def split_ref(request: SplitRefRequest):
+    # Splitting a stored blob is just offset arithmetic: the parts are ranges
+    # of the same blob, and no bytes are read or copied
+    try:
+        blob = parse_ref(request.ref)
+        total = blob_store.size(blob)
+    except BlobNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Blob not found: {e}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    parts = [str(blob.slice(offset, min(request.size, total - offset))) for offset in range(0, total, request.size)]
+    return {"size": total, "parts": parts}
@@ -0,0 +1,77 @@
+import asyncio
+import io
+import os
+import socket
+import tarfile
+import threading
+import time
+import pytest
+import uvicorn
+from main import app
+
+# Runs the app under uvicorn and talks raw HTTP/1.1, so the upload can be
+# held open while the response is read
+
+@pytest.fixture
+def port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, lifespan="off", log_level="warning",
+                                           timeout_graceful_shutdown=1))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield port
+    server.should_exit = True
+    thread.join()
+
+async def read_chunk(reader: asyncio.StreamReader) -> bytes:
+    # One chunk of a chunked response body; b"" at the end
+    size = int((await reader.readline()).strip(), 16)
+    data = await reader.readexactly(size)
+    await reader.readexactly(2)
+    return data
+
+def send_chunk(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+async def split_stream(port: int, data: bytes, size: int) -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        return await exchange(reader, writer, data, size)
+    finally:
+        writer.close()
+
+async def exchange(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes, size: int) -> bytes:
+    writer.write(
+        f"POST /split/stream?size={size} HTTP/1.1\r\nHost: test\r\n"
+        "Content-Type: application/octet-stream\r\nTransfer-Encoding: chunked\r\n\r\n".encode()
+    )
+    # Send the first part and a bit more, then wait for that part to come back
+    # before the rest of the upload is sent
+    send_chunk(writer, data[:size + 100])
+    await writer.drain()
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+    assert head.startswith(b"HTTP/1.1 200")
+    body = b""
+    while len(body) < tarfile.BLOCKSIZE + size:
+        body += await asyncio.wait_for(read_chunk(reader), 5)
+    first = tarfile.TarInfo.frombuf(body[:tarfile.BLOCKSIZE], tarfile.ENCODING, "surrogateescape")
+    assert (first.name, first.size) == ("part_1", size)
+
+    send_chunk(writer, data[size + 100:])
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+    while chunk := await asyncio.wait_for(read_chunk(reader), 5):
+        body += chunk
+    return body
+
+def test_split_stream_returns_parts_before_upload_ends(port):
+    size = 1024
+    data = os.urandom(3 * size + 200)
+    body = asyncio.run(split_stream(port, data, size))
+    with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+        parts = [(m.name, tar.extractfile(m).read()) for m in tar.getmembers()]
+    assert parts == [(f"part_{i + 1}", data[i * size:(i + 1) * size]) for i in range(4)]
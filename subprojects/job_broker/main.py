@@ -1,24 +1,82 @@
-from fastapi import FastAPI, Request, HTTPException
-from pydantic import BaseModel
-import pika
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from prometheus_client import Gauge, Histogram
+from prometheus_fastapi_instrumentator import Instrumentator
+import aio_pika
+import asyncio
+import time
 import uuid
 import json
 import os
-import time
-from typing import Optional
-from enum import Enum
-import redis
+from typing import Optional, Union
+import redis.asyncio as aioredis
+from shared.amqp import ChannelPool
+from shared.notify import SSE_KEEPALIVE, Notifier, next_message, sse_event
+from shared.tracing import SERIALIZATION, add_tracing, extract, inject, record as record_span, timed
+from registry import QUEUE_TTL, TaskTypeConfig, TaskTypeRegistry, configured_task_types
+from scheduler import DEFAULT_TENANT, FairScheduler, Priority, parse_lane_weights
+from task_store import (EXPIRED_DEAD_LETTER, EXPIRED_REQUEUE, LEASE_AT_CAPACITY, LEASE_COMPLETED, LEASE_MISSING,
+                        TaskState, TaskStore, events_channel)
 
 app = FastAPI()
+Instrumentator().instrument(app).expose(app)
+add_tracing(app)
 
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", 5672))
+AMQP_POOL_SIZE = int(os.getenv("AMQP_POOL_SIZE", 8))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", 1))  # seconds between checks for expired leases
+SWEEP_BATCH = 100  # expired leases handled per check
+# Share of fetches each priority lane gets while they all have work
+LANE_WEIGHTS = parse_lane_weights(os.getenv("LANE_WEIGHTS", "interactive=8,normal=4,bulk=1"))
+DEPTH_SAMPLE_INTERVAL = float(os.getenv("DEPTH_SAMPLE_INTERVAL", 15))  # seconds between queue depth samples
+LEGACY_DRAIN_INTERVAL = float(os.getenv("LEGACY_DRAIN_INTERVAL", 15))  # seconds between legacy queue checks
+TASK_RETENTION = int(os.getenv("TASK_RETENTION", 86400))  # seconds a task stays in the index
+LONG_POLL_MAX = float(os.getenv("LONG_POLL_MAX", 60))  # seconds
+FETCH_MAX = int(os.getenv("FETCH_MAX", 100))  # tasks per fetch_job call
+# Tenants accepted on submit besides the default one; any name if unset
+TENANTS = {t.strip() for t in os.getenv("TENANTS", "").split(",") if t.strip()}
+MAX_TENANTS = int(os.getenv("MAX_TENANTS", 100))  # active tenants per task type
+IDLE_LANE_CHECK_INTERVAL = float(os.getenv("IDLE_LANE_CHECK_INTERVAL", 60))  # seconds between idle queue cleanups
+# Blocked fetches also re-check the queue this often (seconds), in case an
+# announcement was missed while the notifier was reconnecting
+FETCH_RECHECK_INTERVAL = 5
+SSE_KEEPALIVE_INTERVAL = 15  # seconds
+
+channel_pool = ChannelPool(RABBITMQ_HOST, RABBITMQ_PORT, size=AMQP_POOL_SIZE)
+# Requests wait for a free connection rather than failing when all are in use
+redis_client = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+    REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS))
+task_store = TaskStore(
+    redis_client,
+    queue_ttl=QUEUE_TTL,
+    retention=TASK_RETENTION,
+)
+registry = TaskTypeRegistry(redis_client)
+scheduler = FairScheduler(redis_client, LANE_WEIGHTS)
+notifier = Notifier(redis_client)
+
+# States a task can't leave; waiting stops once one is reached
+FINAL_STATES = {TaskState.completed, TaskState.expired, TaskState.dead_lettered, TaskState.missing}
 
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
+QUEUE_DEPTH = Gauge("job_broker_queue_depth", "Tasks waiting in a priority lane", ["task_type", "priority"])
+QUEUE_WAIT = Histogram(
+    "job_broker_queue_wait_seconds",
+    "Time from (re)queueing a task until a worker fetches it",
+    ["task_type", "priority"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300),
+)
 
 # --- Models ---
 class SubmitRequest(BaseModel):
     payload: dict
+    priority: Priority = Priority.normal
+    # Tasks of one tenant don't hold up other tenants' tasks in the same lane
+    tenant: str = Field(DEFAULT_TENANT, pattern=r"^[A-Za-z0-9_.-]{1,64}$")
 
 class SubmitResponse(BaseModel):
     task_id: str
@@ -29,17 +87,39 @@ class CompleteRequest(BaseModel):
 class FetchJobResponse(BaseModel):
     task_id: str
     payload: dict
+    attempt: int
+    lease_expires_at: float
+    # Trace context of the task's time in the queue; send it as the
+    # traceparent header of /complete and downstream calls to continue the trace
+    traceparent: Optional[str] = None
+
+class HeartbeatRequest(BaseModel):
+    lease_timeout: Optional[float] = None  # seconds, defaults to the task type's lease_timeout
+
+class HeartbeatResponse(BaseModel):
+    task_id: str
+    lease_expires_at: float
+
+class FetchJobsResponse(BaseModel):
+    tasks: list[FetchJobResponse]
+
+class TaskResult(BaseModel):
+    task_id: str
+    result: dict
+
+class BatchCompleteRequest(BaseModel):
+    results: list[TaskResult]
+
+class CompleteStatus(BaseModel):
+    task_id: str
+    status: str  # ok | not_found
 
-# --- Task State Enum ---
-class TaskState(str, Enum):
-    completed = "completed"
-    queued = "queued"
-    expired = "expired"
-    missing = "missing"
+class BatchCompleteResponse(BaseModel):
+    results: list[CompleteStatus]
 
 class StatusResponse(BaseModel):
     task_id: str
-    state: TaskState  # completed | queued | missing
+    state: TaskState  # completed | queued | processing | expired | dead_lettered | missing
 
 class ResultResponse(BaseModel):
     task_id: str
@@ -47,199 +127,498 @@ class ResultResponse(BaseModel):
     result: Optional[dict]
 
 # --- Queue Name Templates ---
-TASK_QUEUE_TEMPLATE = "task_queue:{task_type}"
-PROCESSING_DELAY_QUEUE_TEMPLATE = "processing_delay:{task_type}"
-RESULT_QUEUE_TEMPLATE = "result_queue:{task_type}"
+TASK_QUEUE_TEMPLATE = "task_queue:{task_type}:{priority}:{tenant}"
 DLQ_QUEUE_TEMPLATE = "task_queue:{task_type}:dlq"
+# The single queue per type used before priority lanes and tenants
+LEGACY_QUEUE_TEMPLATE = "task_queue:{task_type}"
 
-def task_queue_name(task_type):
-    return TASK_QUEUE_TEMPLATE.format(task_type=task_type)
-
-def processing_delay_queue_name(task_type):
-    return PROCESSING_DELAY_QUEUE_TEMPLATE.format(task_type=task_type)
-
-def result_queue_name(task_type):
-    return RESULT_QUEUE_TEMPLATE.format(task_type=task_type)
+def task_queue_name(task_type, priority, tenant):
+    return TASK_QUEUE_TEMPLATE.format(task_type=task_type, priority=priority.value, tenant=tenant)
 
 def dlq_queue_name(task_type):
     return DLQ_QUEUE_TEMPLATE.format(task_type=task_type)
 
+def submitted_channel(task_type):
+    # Announces new tasks to fetches blocked on an empty queue
+    return f"task_queue:{task_type}:submitted"
+
 # --- RabbitMQ Helpers ---
-def get_connection():
-    while True:
-        try:
-            return pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT))
-        except pika.exceptions.AMQPConnectionError:
-            print("Waiting for RabbitMQ...")
-            time.sleep(2)
-
-def declare_queues(channel, task_type):
-    # Dead Letter Queue
-    channel.queue_declare(queue=dlq_queue_name(task_type), durable=True)
-    # Task queue with DLQ
-    channel.queue_declare(
-        queue=task_queue_name(task_type),
+async def declare_queues(channel, task_type, priority, tenant):
+    # Declarations are cached by the pool, so this is a no-op after the first call
+    # Dead Letter Queue, shared by all lanes and tenants
+    await channel_pool.declare_queue(channel, dlq_queue_name(task_type), durable=True)
+    # One task queue per lane and tenant, with DLQ
+    await channel_pool.declare_queue(
+        channel,
+        task_queue_name(task_type, priority, tenant),
         durable=True,
+        # The TTL is set per message, so changing a type's queue_ttl doesn't
+        # require redeclaring (and so deleting) its queues
         arguments={
-            'x-message-ttl': 300000,  # 5 min
             'x-dead-letter-exchange': '',
             'x-dead-letter-routing-key': dlq_queue_name(task_type)
         }
     )
-    # Processing delay queue (TTL, DLX)
-    channel.queue_declare(
-        queue=processing_delay_queue_name(task_type),
-        durable=True,
-        arguments={
-            'x-message-ttl': 300000,  # 5 min
-            'x-dead-letter-exchange': '',
-            'x-dead-letter-routing-key': task_queue_name(task_type)
-        }
-    )
-    # Result queue
-    channel.queue_declare(queue=result_queue_name(task_type), durable=True)
+
+async def declare_topology(task_type):
+    # Queues of the default tenant, declared up front; other tenants' queues
+    # are declared (once) on their first submit
+    async with channel_pool.channel() as channel:
+        for priority in Priority:
+            await declare_queues(channel, task_type, priority, DEFAULT_TENANT)
+
+# Task types whose legacy queue may still receive tasks (from instances not
+# yet upgraded); checked until the queue is deleted
+legacy_queues: set[str] = set()
+
+async def drain_legacy_queue(task_type: str, config: TaskTypeConfig) -> int:
+    # Moves tasks from the legacy queue to the default tenant's normal lane.
+    # The queue itself is left for the operator to delete once no old
+    # instance publishes to it; deleting it earlier would drop their tasks.
+    legacy = LEGACY_QUEUE_TEMPLATE.format(task_type=task_type)
+    try:
+        async with channel_pool.channel() as channel:
+            await channel.declare_queue(legacy, passive=True, robust=False)
+    except aio_pika.exceptions.ChannelNotFoundEntity:
+        legacy_queues.discard(task_type)
+        return 0
+    queue = task_queue_name(task_type, Priority.normal, DEFAULT_TENANT)
+    moved = 0
+    async with channel_pool.channel() as channel:
+        while (incoming := await channel_pool.get(channel, legacy)) is not None:
+            with timed(SERIALIZATION, "task_decode"):
+                message = json.loads(incoming.body)
+            await publish_to_lane(channel, task_type, Priority.normal, DEFAULT_TENANT, message, config.queue_ttl)
+            await incoming.ack()
+            moved += 1
+    if moved:
+        print(f"Moved {moved} tasks from {legacy} to {queue}")
+        await scheduler.mark_active(task_type, Priority.normal, DEFAULT_TENANT)
+        await redis_client.publish(submitted_channel(task_type), "")
+    return moved
+
+async def run_legacy_drainer():
+    while True:
+        for task_type, config in (await registry.all()).items():
+            if task_type not in legacy_queues:
+                continue
+            try:
+                await drain_legacy_queue(task_type, config)
+            except Exception as e:
+                print(f"Draining the legacy queue of {task_type} failed: {e!r}")
+        await asyncio.sleep(LEGACY_DRAIN_INTERVAL)
+
+async def publish_task(channel, queue, message, ttl: Optional[float] = None) -> bool:
+    # False if the queue doesn't exist
+    with timed(SERIALIZATION, "task_encode"):
+        body = json.dumps(message).encode()
+    return await channel_pool.publish(channel, queue, aio_pika.Message(
+        body,
+        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        content_type='application/json',
+        expiration=ttl,
+        headers=inject({}),
+    ))
+
+async def publish_to_lane(channel, task_type, priority, tenant, message, ttl: float):
+    # The queue may have been deleted as idle (by any instance) since this one
+    # declared it; then it is declared again
+    queue = task_queue_name(task_type, priority, tenant)
+    await declare_queues(channel, task_type, priority, tenant)
+    if await publish_task(channel, queue, message, ttl):
+        return
+    channel_pool.forget(queue)
+    await declare_queues(channel, task_type, priority, tenant)
+    if not await publish_task(channel, queue, message, ttl):
+        raise RuntimeError(f"Queue {queue} disappeared while publishing")
+
+# --- Task Types ---
+async def require_task_type(task_type: str) -> TaskTypeConfig:
+    config = await registry.get(task_type)
+    if config is None:
+        raise HTTPException(status_code=404, detail=f"Unknown task type: {task_type}")
+    return config
+
+@app.get("/task_types", response_model=dict[str, TaskTypeConfig])
+async def list_task_types():
+    return await registry.all()
+
+@app.get("/task_types/{task_type}", response_model=TaskTypeConfig)
+async def get_task_type(task_type: str):
+    return await require_task_type(task_type)
+
+@app.put("/task_types/{task_type}", response_model=TaskTypeConfig)
+async def put_task_type(task_type: str, config: TaskTypeConfig):
+    await declare_topology(task_type)
+    await registry.put(task_type, config)
+    return config
 
 # --- API Endpoints ---
-@app.post("/submit/{task_type}", response_model=SubmitResponse)
-def submit_job(task_type: str, req: SubmitRequest):
-    task_id = str(uuid.uuid4())
-    message = {
+def task_message(task_id, task_type, payload):
+    # enqueued_at rides along so fetches can measure queue wait without a lookup
+    return {
         "task_id": task_id,
         "task_type": task_type,
-        "payload": req.payload,
-        "result": None
+        "payload": payload,
+        "result": None,
+        "enqueued_at": time.time(),
     }
-    conn = get_connection()
-    channel = conn.channel()
-    declare_queues(channel, task_type)
-    channel.basic_publish(
-        exchange='',
-        routing_key=task_queue_name(task_type),
-        body=json.dumps(message),
-        properties=pika.BasicProperties(
-            delivery_mode=2,  # persistent
-            content_type='application/json',
-        )
-    )
-    conn.close()
+
+@app.post("/submit/{task_type}", response_model=SubmitResponse)
+async def submit_job(task_type: str, req: SubmitRequest):
+    config = await require_task_type(task_type)
+    if len(json.dumps(req.payload)) > config.max_payload_bytes:
+        raise HTTPException(status_code=413, detail=f"Payload larger than {config.max_payload_bytes} bytes")
+    if TENANTS and req.tenant != DEFAULT_TENANT and req.tenant not in TENANTS:
+        raise HTTPException(status_code=403, detail=f"Unknown tenant: {req.tenant}")
+    # Every tenant gets its own durable queues, so their number is bounded
+    if not await scheduler.admit(task_type, req.tenant, config.queue_ttl, MAX_TENANTS):
+        raise HTTPException(status_code=429, detail=f"Too many active tenants for {task_type}")
+    task_id = str(uuid.uuid4())
+    message = task_message(task_id, task_type, req.payload)
+    queue = task_queue_name(task_type, req.priority, req.tenant)
+    await task_store.create(task_id, task_type, req.payload, queue, req.priority.value, req.tenant, config.queue_ttl)
+    async with channel_pool.channel() as channel:
+        await publish_to_lane(channel, task_type, req.priority, req.tenant, message, config.queue_ttl)
+    await scheduler.mark_active(task_type, req.priority, req.tenant)
+    await redis_client.publish(submitted_channel(task_type), task_id)
     return {"task_id": task_id}
 
-@app.post("/fetch_job/{task_type}", response_model=FetchJobResponse)
-def fetch_job(task_type: str):
-    conn = get_connection()
-    channel = conn.channel()
-    declare_queues(channel, task_type)
-    method, props, body = channel.basic_get(queue=task_queue_name(task_type), auto_ack=False)
-    if not method:
-        conn.close()
+class AtCapacity(Exception):
+    # The task type already has max_concurrency tasks leased
+    pass
+
+async def lease_message(incoming, task_type, priority, tenant, config, lease_timeout) -> Optional[dict]:
+    # Leases the task behind a fetched message; None if it was already completed.
+    # The message is acked as soon as the task is leased; from then on the
+    # lease in Redis, not the queue, decides when the task is handed out again
+    with timed(SERIALIZATION, "task_decode"):
+        message = json.loads(incoming.body)
+    task_id = message["task_id"]
+    attempt, lease_expires_at = await task_store.lease(task_id, task_type, lease_timeout, config.max_concurrency)
+    if attempt == LEASE_MISSING:
+        # Message published before the index existed (or outlived its retention)
+        await task_store.create(task_id, task_type, message["payload"], task_queue_name(task_type, priority, tenant),
+                                priority.value, tenant, config.queue_ttl)
+        attempt, lease_expires_at = await task_store.lease(task_id, task_type, lease_timeout, config.max_concurrency)
+    if attempt == LEASE_AT_CAPACITY:
+        await incoming.nack(requeue=True)
+        raise AtCapacity()
+    await incoming.ack()
+    if attempt == LEASE_COMPLETED:
+        # Completed by a previous worker; this is a stale redelivery, drop it
+        return None
+    traceparent = None
+    if "enqueued_at" in message:
+        QUEUE_WAIT.labels(task_type, priority.value).observe(max(0, time.time() - message["enqueued_at"]))
+        # Continues the submitter's trace (requeued tasks start a new one)
+        waited = record_span("queue wait", message["enqueued_at"], extract(incoming.headers),
+                             task_id=task_id, task_type=task_type, attempt=attempt)
+        traceparent = waited.traceparent
+    return {
+        "task_id": task_id,
+        "payload": message["payload"],
+        "attempt": attempt,
+        "lease_expires_at": lease_expires_at,
+        "traceparent": traceparent,
+    }
+
+async def take_job(channel, task_type: str, tenants: dict, config: TaskTypeConfig, lease_timeout: float) -> Optional[dict]:
+    # Takes one task from the lane picked by the scheduler, from the next
+    # tenant in turn. Queues found empty are dropped from `tenants`, so the
+    # rest of the fetch doesn't probe them again.
+    for priority in scheduler.lane_order():
+        for tenant in scheduler.tenant_order(task_type, priority, tenants[priority]):
+            await declare_queues(channel, task_type, priority, tenant)
+            while True:
+                incoming = await channel_pool.get(channel, task_queue_name(task_type, priority, tenant))
+                if incoming is None:
+                    tenants[priority].remove(tenant)
+                    break
+                task = await lease_message(incoming, task_type, priority, tenant, config, lease_timeout)
+                if task is not None:
+                    return task
+    return None
+
+async def take_jobs(task_type: str, config: TaskTypeConfig, limit: int, lease_timeout: float) -> list[dict]:
+    if config.max_concurrency is not None:
+        # Cheap pre-check; the lease itself enforces the limit exactly
+        limit = min(limit, config.max_concurrency - await task_store.leased_count(task_type))
+        if limit <= 0:
+            return []
+    tenants = await scheduler.active_tenants(task_type, config.queue_ttl)
+    tasks = []
+    async with channel_pool.channel() as channel:
+        while len(tasks) < limit:
+            try:
+                task = await take_job(channel, task_type, tenants, config, lease_timeout)
+            except AtCapacity:
+                break
+            if task is None:
+                break
+            tasks.append(task)
+    return tasks
+
+@app.post("/fetch_job/{task_type}", response_model=Union[FetchJobResponse, FetchJobsResponse])
+async def fetch_job(
+    task_type: str,
+    max_tasks: Optional[int] = Query(None, alias="max", ge=1, le=FETCH_MAX),
+    wait: float = Query(0, ge=0, le=LONG_POLL_MAX),
+    lease_timeout: Optional[float] = Query(None, alias="lease", gt=0),
+):
+    # Without `max` a single task is returned (404 when there is none); with
+    # it, up to `max` tasks as a list. `wait` blocks for up to that many
+    # seconds until work arrives instead of returning empty-handed. Fetched
+    # tasks are leased for `lease` seconds (the type's lease_timeout by
+    # default); see /heartbeat.
+    config = await require_task_type(task_type)
+    lease_timeout = lease_timeout or config.lease_timeout
+    limit = max_tasks or 1
+    tasks = await take_jobs(task_type, config, limit, lease_timeout)
+    if not tasks and wait:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        async with notifier.subscribe(submitted_channel(task_type)) as submitted:
+            while True:
+                # Re-check after subscribing so a submit in between isn't missed
+                tasks = await take_jobs(task_type, config, limit, lease_timeout)
+                remaining = deadline - loop.time()
+                if tasks or remaining <= 0:
+                    break
+                await next_message(submitted, min(remaining, FETCH_RECHECK_INTERVAL))
+    if max_tasks is not None:
+        return {"tasks": tasks}
+    if not tasks:
         raise HTTPException(status_code=404, detail="No pending jobs")
-    message = json.loads(body)
-    # Move to processing_delay queue (with TTL)
-    channel.basic_publish(
-        exchange='',
-        routing_key=processing_delay_queue_name(task_type),
-        body=json.dumps(message),
-        properties=pika.BasicProperties(
-            delivery_mode=2,
-            content_type='application/json',
-        )
-    )
-    channel.basic_ack(method.delivery_tag)
-    conn.close()
-    return {"task_id": message["task_id"], "payload": message["payload"]}
+    return tasks[0]
+
+async def get_task(task_type: str, task_id: str) -> Optional[dict]:
+    record = await task_store.get(task_id)
+    if record is None or record["task_type"] != task_type:
+        return None
+    return record
 
 @app.post("/complete/{task_type}/{task_id}")
-def complete_job(task_type: str, task_id: str, req: CompleteRequest):
-    conn = get_connection()
-    channel = conn.channel()
-    # Scan processing_delay queue for the task_id
-    queue = processing_delay_queue_name(task_type)
-    msg = None
-    for _ in range(100):
-        method, props, body = channel.basic_get(queue=queue, auto_ack=False)
-        if not method:
-            break
-        candidate = json.loads(body)
-        if candidate["task_id"] == task_id:
-            msg = candidate
-            channel.basic_ack(method.delivery_tag)
-            break
-        else:
-            channel.basic_nack(method.delivery_tag, requeue=True)
-    if not msg:
-        conn.close()
+async def complete_job(task_type: str, task_id: str, req: CompleteRequest):
+    record = await get_task(task_type, task_id)
+    if record is None or record["state"] != TaskState.processing:
         raise HTTPException(status_code=404, detail="Task not found in processing queue")
-    # Publish to result_queue
-    msg["result"] = req.result
-    channel.basic_publish(
-        exchange='',
-        routing_key=result_queue_name(task_type),
-        body=json.dumps(msg),
-        properties=pika.BasicProperties(
-            delivery_mode=2,
-            content_type='application/json',
-        )
-    )
-    conn.close()
+    await task_store.complete(task_id, task_type, req.result)
     return {"status": "ok"}
 
-@app.get("/status/{task_type}/{task_id}", response_model=StatusResponse)
-def get_status(task_type: str, task_id: str):
-    # 1. Check if result exists in Redis
-    result = redis_client.get(f"job:{task_id}:result")
-    if result:
-        return {"task_id": task_id, "state": TaskState.completed}
-    # 2. Check if job is in the queue (pending or processing)
-    conn = get_connection()
-    channel = conn.channel()
-    found = False
-    for queue in [task_queue_name(task_type), processing_delay_queue_name(task_type)]:
-        for _ in range(10):  # small scan limit
-            method, props, body = channel.basic_get(queue=queue, auto_ack=False)
-            if not method:
+@app.post("/complete/{task_type}", response_model=BatchCompleteResponse)
+async def complete_jobs(task_type: str, req: BatchCompleteRequest):
+    # Completes many tasks in one call; each one is reported individually
+    task_ids = [item.task_id for item in req.results]
+    records = await task_store.get_many(task_ids)
+    completed = {}
+    statuses = []
+    for item, record in zip(req.results, records):
+        if record is None or record["task_type"] != task_type or record["state"] != TaskState.processing:
+            statuses.append({"task_id": item.task_id, "status": "not_found"})
+            continue
+        completed[item.task_id] = item.result
+        statuses.append({"task_id": item.task_id, "status": "ok"})
+    await task_store.complete_many(task_type, completed)
+    return {"results": statuses}
+
+@app.post("/heartbeat/{task_type}/{task_id}", response_model=HeartbeatResponse)
+async def heartbeat(task_type: str, task_id: str, req: Optional[HeartbeatRequest] = None):
+    # Extends the lease of a task that is still being worked on. Once a lease
+    # has expired the task may already be with another worker, so that's a 404.
+    config = await require_task_type(task_type)
+    lease_timeout = req.lease_timeout if req is not None and req.lease_timeout else config.lease_timeout
+    record = await get_task(task_type, task_id)
+    lease_expires_at = None if record is None else await task_store.heartbeat(task_id, task_type, lease_timeout)
+    if lease_expires_at is None:
+        raise HTTPException(status_code=404, detail="Task is not leased")
+    return {"task_id": task_id, "lease_expires_at": lease_expires_at}
+
+# --- Lease Sweeper ---
+def record_queue(record) -> tuple[Priority, str]:
+    return Priority(record.get("priority", Priority.normal.value)), record.get("tenant", DEFAULT_TENANT)
+
+async def sweep_expired_leases(task_type: str, config: TaskTypeConfig) -> int:
+    task_ids = await task_store.expired_leases(task_type, SWEEP_BATCH)
+    for task_id in task_ids:
+        record = await task_store.get(task_id)
+        if record is None:
+            continue
+        priority, tenant = record_queue(record)
+        queue = task_queue_name(task_type, priority, tenant)
+        outcome = await task_store.expire_lease(task_id, task_type, config.max_attempts, queue, dlq_queue_name(task_type))
+        if outcome not in (EXPIRED_REQUEUE, EXPIRED_DEAD_LETTER):
+            continue
+        message = task_message(task_id, task_type, record["payload"])
+        try:
+            async with channel_pool.channel() as channel:
+                if outcome == EXPIRED_REQUEUE:
+                    await publish_to_lane(channel, task_type, priority, tenant, message, config.queue_ttl)
+                else:
+                    await declare_queues(channel, task_type, priority, tenant)
+                    await publish_task(channel, dlq_queue_name(task_type), message)
+        except Exception as e:
+            print(f"Failed to requeue task {task_id}: {e!r}")
+            await task_store.restore_lease(task_id, task_type, SWEEP_INTERVAL)
+            continue
+        if outcome == EXPIRED_REQUEUE:
+            await scheduler.mark_active(task_type, priority, tenant)
+            await redis_client.publish(submitted_channel(task_type), task_id)
+    return len(task_ids)
+
+async def run_sweeper():
+    # Every instance sweeps; claiming a lease is atomic, so each one is handled once
+    while True:
+        busy = False
+        try:
+            for task_type, config in (await registry.all()).items():
+                busy |= await sweep_expired_leases(task_type, config) >= SWEEP_BATCH
+        except Exception as e:
+            print(f"Lease sweep failed: {e!r}")
+        if not busy:
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+async def wait_for_task(task_type: str, task_id: str, wait: float):
+    # Long-poll: returns as soon as the task reaches a final state, or at the timeout
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    async with notifier.subscribe(events_channel(task_id)) as events:
+        record = await get_task(task_type, task_id)
+        state = task_store.effective_state(record)
+        while state not in FINAL_STATES:
+            message = await next_message(events, deadline - loop.time())
+            # Expiry is derived from timestamps rather than announced, so re-read either way
+            record = await get_task(task_type, task_id)
+            state = task_store.effective_state(record)
+            if message is None:
                 break
-            msg = json.loads(body)
-            if msg["task_id"] == task_id:
-                channel.basic_nack(method.delivery_tag, requeue=True)
-                conn.close()
-                return {"task_id": task_id, "state": TaskState.queued}
-            channel.basic_nack(method.delivery_tag, requeue=True)
-    # 3. Check DLQ for expired/dropped jobs
-    dlq = dlq_queue_name(task_type)
-    for _ in range(10):
-        method, props, body = channel.basic_get(queue=dlq, auto_ack=False)
-        if not method:
-            break
-        msg = json.loads(body)
-        if msg["task_id"] == task_id:
-            channel.basic_nack(method.delivery_tag, requeue=True)
-            conn.close()
-            return {"task_id": task_id, "state": TaskState.expired}
-        channel.basic_nack(method.delivery_tag, requeue=True)
-    conn.close()
-    # 4. Otherwise, missing
-    return {"task_id": task_id, "state": TaskState.missing}
+    return record, state
+
+@app.get("/status/{task_type}/{task_id}", response_model=StatusResponse)
+async def get_status(task_type: str, task_id: str, wait: float = Query(0, ge=0, le=LONG_POLL_MAX)):
+    if wait:
+        _, state = await wait_for_task(task_type, task_id, wait)
+    else:
+        record = await get_task(task_type, task_id)
+        state = task_store.effective_state(record)
+    return {"task_id": task_id, "state": state}
 
 @app.get("/result/{task_type}/{task_id}", response_model=ResultResponse)
-def get_result(task_type: str, task_id: str):
-    conn = get_connection()
-    channel = conn.channel()
-    queue = result_queue_name(task_type)
-    for _ in range(100):
-        method, props, body = channel.basic_get(queue=queue, auto_ack=False)
-        if not method:
-            break
-        msg = json.loads(body)
-        if msg["task_id"] == task_id:
-            channel.basic_nack(method.delivery_tag, requeue=True)
-            conn.close()
-            return {"task_id": task_id, "state": TaskState.complete, "result": msg["result"]}
-        else:
-            channel.basic_nack(method.delivery_tag, requeue=True)
-    conn.close()
-    raise HTTPException(status_code=404, detail="Result not found")
+async def get_result(task_type: str, task_id: str, wait: float = Query(0, ge=0, le=LONG_POLL_MAX)):
+    if wait:
+        record, state = await wait_for_task(task_type, task_id, wait)
+    else:
+        record = await get_task(task_type, task_id)
+        state = task_store.effective_state(record)
+    if state != TaskState.completed:
+        raise HTTPException(status_code=404, detail="Result not found")
+    return {"task_id": task_id, "state": TaskState.completed, "result": record["result"]}
+
+@app.get("/events/{task_type}/{task_id}")
+async def task_events(task_type: str, task_id: str):
+    # Server-sent events: a "state" event whenever the task's state changes,
+    # ending with the result once it completes
+    async def events():
+        async with notifier.subscribe(events_channel(task_id)) as updates:
+            last_state = None
+            while True:
+                record = await get_task(task_type, task_id)
+                state = task_store.effective_state(record)
+                if state != last_state:
+                    data = {"task_id": task_id, "state": state.value}
+                    if state == TaskState.completed:
+                        data["result"] = record["result"]
+                    yield sse_event("state", data)
+                    last_state = state
+                if state in FINAL_STATES:
+                    return
+                if await next_message(updates, SSE_KEEPALIVE_INTERVAL) is None:
+                    yield SSE_KEEPALIVE
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def sample_queue_depths():
+    for task_type, config in (await registry.all()).items():
+        tenants = await scheduler.active_tenants(task_type, config.queue_ttl)
+        async with channel_pool.channel() as channel:
+            for priority in Priority:
+                depth = 0
+                for tenant in tenants[priority]:
+                    await declare_queues(channel, task_type, priority, tenant)
+                    # On the underlying channel: the robust channel answers a passive
+                    # declare of a queue it declared from its cache, with the
+                    # message count of that first declare
+                    underlay = await channel.get_underlay_channel()
+                    declared = await underlay.queue_declare(task_queue_name(task_type, priority, tenant), passive=True)
+                    depth += declared.message_count
+                QUEUE_DEPTH.labels(task_type, priority.value).set(depth)
+
+async def run_depth_sampler():
+    while True:
+        await asyncio.sleep(DEPTH_SAMPLE_INTERVAL)
+        try:
+            await sample_queue_depths()
+        except Exception as e:
+            print(f"Queue depth sample failed: {e!r}")
+
+async def delete_idle_lanes():
+    # Queues of tenants that haven't submitted for a queue TTL are empty (their
+    # tasks have expired), so they are deleted rather than kept forever. The
+    # default tenant's queues are part of the topology and stay. The extra
+    # interval keeps a fetch that has just listed a tenant off its deleted queue.
+    for task_type, config in (await registry.all()).items():
+        idle_after = config.queue_ttl + IDLE_LANE_CHECK_INTERVAL
+        idle = await scheduler.idle_tenants(task_type, idle_after)
+        for priority in Priority:
+            for tenant in idle[priority]:
+                if tenant != DEFAULT_TENANT:
+                    queue = task_queue_name(task_type, priority, tenant)
+                    try:
+                        async with channel_pool.channel() as channel:
+                            if not await channel_pool.delete_if_empty(channel, queue):
+                                continue
+                    except aio_pika.exceptions.ChannelPreconditionFailed:
+                        continue  # a task arrived in between
+                    except aio_pika.exceptions.ChannelNotFoundEntity:
+                        channel_pool.forget(queue)
+                await scheduler.forget(task_type, priority, tenant, idle_after)
+
+async def run_lane_cleaner():
+    while True:
+        await asyncio.sleep(IDLE_LANE_CHECK_INTERVAL)
+        try:
+            await delete_idle_lanes()
+        except Exception as e:
+            print(f"Idle queue cleanup failed: {e!r}")
+
+async def load_task_types():
+    await registry.load(configured_task_types())
+    for task_type in await registry.all():
+        await declare_topology(task_type)
+        legacy_queues.add(task_type)
+
+background_tasks = []
+
+@app.on_event("startup")
+async def start_background():
+    await channel_pool.start()
+    await load_task_types()
+    await notifier.start()
+    background_tasks.append(asyncio.create_task(run_sweeper()))
+    background_tasks.append(asyncio.create_task(run_depth_sampler()))
+    background_tasks.append(asyncio.create_task(run_legacy_drainer()))
+    background_tasks.append(asyncio.create_task(run_lane_cleaner()))
+
+@app.on_event("shutdown")
+async def stop_background():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await notifier.stop()
+    await channel_pool.close()
+    await redis_client.aclose()
 
 # --- Notes ---
-# - For demo, task_types are hardcoded. In production, you may want to keep a registry or config of valid types.
-# - Scanning queues is inefficient for large queues, but matches the design.
+# - Task types must be registered (registry.py) through TASK_TYPES / TASK_TYPES_FILE or PUT /task_types/{task_type}.
+# - Task state lives in the Redis index (task_store.py); the queues only carry work to workers.
 # - Error handling is basic; production code should be more robust.
@@ -0,0 +1,71 @@
+import json
+import os
+import time
+from typing import Optional
+from pydantic import BaseModel, Field
+
+# Defaults for settings a task type doesn't specify
+QUEUE_TTL = float(os.getenv("QUEUE_TTL", 300))  # seconds a task may wait in its queue
+LEASE_TIMEOUT = float(os.getenv("LEASE_TIMEOUT", 300))  # seconds a fetched task stays leased without a heartbeat
+MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", 3))  # leases that may expire before a task is dead-lettered
+MAX_PAYLOAD_BYTES = int(os.getenv("MAX_PAYLOAD_BYTES", 1024 * 1024))
+
+# Task types registered at startup: a JSON object of name -> settings, given
+# inline or as a file, e.g. {"transcribe": {"lease_timeout": 1800}, "echo": {}}
+TASK_TYPES = os.getenv("TASK_TYPES", "")
+TASK_TYPES_FILE = os.getenv("TASK_TYPES_FILE", "")
+# Seconds a looked-up task type (or its absence) is trusted before asking
+# Redis again; this is how long a type registered on another instance can
+# take to show up here
+TASK_TYPE_CACHE_TTL = float(os.getenv("TASK_TYPE_CACHE_TTL", 30))
+
+REGISTRY_KEY = "task_types"
+
+class TaskTypeConfig(BaseModel):
+    queue_ttl: float = Field(QUEUE_TTL, gt=0)
+    lease_timeout: float = Field(LEASE_TIMEOUT, gt=0)
+    max_attempts: int = Field(MAX_ATTEMPTS, ge=1)  # then the task goes to the DLQ
+    max_payload_bytes: int = Field(MAX_PAYLOAD_BYTES, gt=0)
+    max_concurrency: Optional[int] = Field(None, ge=1)  # tasks leased at once, unlimited if unset
+
+def configured_task_types() -> dict[str, TaskTypeConfig]:
+    raw = TASK_TYPES
+    if TASK_TYPES_FILE:
+        with open(TASK_TYPES_FILE) as f:
+            raw = f.read()
+    if not raw.strip():
+        return {}
+    return {name: TaskTypeConfig(**settings) for name, settings in json.loads(raw).items()}
+
+# Known task types and their settings. Redis holds the registry so every
+# instance sees types added through the API; lookups are served from a local
+# cache, so the hot path doesn't pay a round trip per call.
+class TaskTypeRegistry:
+    def __init__(self, client, cache_ttl: float = TASK_TYPE_CACHE_TTL):
+        self.client = client
+        self.cache_ttl = cache_ttl
+        self.cache: dict[str, tuple[float, Optional[TaskTypeConfig]]] = {}
+
+    async def load(self, configs: dict[str, TaskTypeConfig]) -> None:
+        # Configured types overwrite whatever was registered before
+        if configs:
+            await self.client.hset(REGISTRY_KEY, mapping={name: config.model_dump_json() for name, config in configs.items()})
+        self.cache.clear()
+
+    async def get(self, name: str) -> Optional[TaskTypeConfig]:
+        now = time.monotonic()
+        entry = self.cache.get(name)
+        if entry is not None and now - entry[0] < self.cache_ttl:
+            return entry[1]
+        raw = await self.client.hget(REGISTRY_KEY, name)
+        config = None if raw is None else TaskTypeConfig.model_validate_json(raw)
+        self.cache[name] = (now, config)
+        return config
+
+    async def put(self, name: str, config: TaskTypeConfig) -> None:
+        await self.client.hset(REGISTRY_KEY, name, config.model_dump_json())
+        self.cache[name] = (time.monotonic(), config)
+
+    async def all(self) -> dict[str, TaskTypeConfig]:
+        return {raw_name.decode(): TaskTypeConfig.model_validate_json(raw)
+                for raw_name, raw in (await self.client.hgetall(REGISTRY_KEY)).items()}
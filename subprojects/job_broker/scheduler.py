@@ -0,0 +1,101 @@
+import itertools
+import time
+from enum import Enum
+
+# --- Priority Lanes ---
+class Priority(str, Enum):
+    interactive = "interactive"
+    normal = "normal"
+    bulk = "bulk"
+
+DEFAULT_TENANT = "default"
+
+def parse_lane_weights(value: str) -> dict[Priority, int]:
+    # "interactive=8,normal=4,bulk=1"; lanes left out keep a weight of 1
+    weights = {lane: 1 for lane in Priority}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition("=")
+        weights[Priority(name.strip())] = max(1, int(weight))
+    return weights
+
+def lane_cycle(weights: dict[Priority, int]) -> list[Priority]:
+    # Smooth weighted round-robin: with weights 4/2/1 the cycle is
+    # interactive, normal, interactive, bulk, interactive, normal, interactive,
+    # so a heavier lane gets more turns without taking them all in a row
+    current = {lane: 0 for lane in weights}
+    total = sum(weights.values())
+    cycle = []
+    for _ in range(total):
+        for lane, weight in weights.items():
+            current[lane] += weight
+        chosen = max(current, key=lambda lane: (current[lane], weights[lane]))
+        current[chosen] -= total
+        cycle.append(chosen)
+    return cycle
+
+def tenants_key(task_type: str, lane: Priority) -> str:
+    return f"task_queue:{task_type}:{lane.value}:tenants"
+
+# Drop a tenant from a lane unless it has been marked active since ARGV[2]
+FORGET_SCRIPT = """
+local seen = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if seen and tonumber(seen) < tonumber(ARGV[2]) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+"""
+
+# Decides which lane/tenant queue a fetch takes its next task from. Lanes are
+# visited in weighted turns, falling back to the other lanes (highest priority
+# first) when the chosen one is empty. Within a lane, tenants take turns, so a
+# tenant with a large backlog gets the same share as one with a single task.
+class FairScheduler:
+    def __init__(self, client, weights: dict[Priority, int]):
+        self.client = client
+        self.cycle = lane_cycle(weights)
+        self.ticks = itertools.count()
+        self.tenant_ticks = {}
+        self._forget = client.register_script(FORGET_SCRIPT)
+
+    async def mark_active(self, task_type: str, lane: Priority, tenant: str) -> None:
+        await self.client.zadd(tenants_key(task_type, lane), {tenant: time.time()})
+
+    async def _tenants(self, task_type: str, low, high) -> dict[Priority, list[str]]:
+        pipe = self.client.pipeline(transaction=False)
+        for lane in Priority:
+            pipe.zrangebyscore(tenants_key(task_type, lane), low, high)
+        results = await pipe.execute()
+        return {lane: [raw.decode() for raw in results[i]] for i, lane in enumerate(Priority)}
+
+    async def active_tenants(self, task_type: str, active_window: float) -> dict[Priority, list[str]]:
+        # A tenant stays active for a lane until it hasn't submitted for
+        # active_window seconds (the queue TTL); its messages would have
+        # expired from the queue by then anyway
+        return await self._tenants(task_type, time.time() - active_window, "+inf")
+
+    async def idle_tenants(self, task_type: str, active_window: float) -> dict[Priority, list[str]]:
+        # Tenants that have dropped out of active_tenants, whose queues can go
+        return await self._tenants(task_type, 0, f"({time.time() - active_window}")
+
+    async def admit(self, task_type: str, tenant: str, active_window: float, max_tenants: int) -> bool:
+        # Whether a submit for `tenant` stays within max_tenants active tenants
+        # of the type. Checked before the submit marks the tenant active, so
+        # concurrent first submits of new tenants may overshoot slightly.
+        active = set().union(*(await self.active_tenants(task_type, active_window)).values())
+        return tenant in active or len(active) < max_tenants
+
+    async def forget(self, task_type: str, lane: Priority, tenant: str, active_window: float) -> None:
+        # Drops an idle tenant from a lane, unless it has submitted since
+        await self._forget(keys=[tenants_key(task_type, lane)], args=[tenant, time.time() - active_window])
+
+    def lane_order(self) -> list[Priority]:
+        first = self.cycle[next(self.ticks) % len(self.cycle)]
+        return [first] + [lane for lane in Priority if lane != first]
+
+    def tenant_order(self, task_type: str, lane: Priority, tenants: list[str]) -> list[str]:
+        if not tenants:
+            return []
+        ticks = self.tenant_ticks.setdefault((task_type, lane), itertools.count())
+        start = next(ticks) % len(tenants)
+        return tenants[start:] + tenants[:start]
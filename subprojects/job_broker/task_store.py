@@ -0,0 +1,205 @@
+import json
+import time
+from enum import Enum
+from typing import Optional
+
+# --- Task State Enum ---
+class TaskState(str, Enum):
+    completed = "completed"
+    queued = "queued"
+    processing = "processing"
+    expired = "expired"
+    dead_lettered = "dead_lettered"
+    missing = "missing"
+
+TASK_KEY_TEMPLATE = "task:{task_id}"
+# Sorted set of task_id scored by lease deadline, one per task type
+LEASES_KEY_TEMPLATE = "task_leases:{task_type}"
+
+def task_key(task_id):
+    return TASK_KEY_TEMPLATE.format(task_id=task_id)
+
+def leases_key(task_type):
+    return LEASES_KEY_TEMPLATE.format(task_type=task_type)
+
+def events_channel(task_id):
+    # State changes are published here for long-polls and event streams
+    return f"{task_key(task_id)}:events"
+
+# Lease a task to a worker unless it has already completed: marks it
+# processing, counts the attempt and records the lease deadline. Returns the
+# attempt number, 0 if the task is unknown, -1 if it was already completed or
+# -2 if its type already has ARGV[4] tasks leased (0 for no limit).
+LEASE_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if not state then return 0 end
+if state == 'completed' then return -1 end
+local limit = tonumber(ARGV[4])
+if limit > 0 and redis.call('ZCARD', KEYS[2]) >= limit then return -2 end
+redis.call('HSET', KEYS[1], 'state', 'processing', 'queue', '', 'fetched_at', ARGV[2], 'lease_expires_at', ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+return redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+"""
+
+# Push out the deadline of a lease that is still held. Returns 1 if extended.
+HEARTBEAT_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'state') ~= 'processing' then return 0 end
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then return 0 end
+redis.call('ZADD', KEYS[2], 'XX', ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[1], 'lease_expires_at', ARGV[2])
+return 1
+"""
+
+# Take an expired lease away from its worker. Removing it from the lease set
+# is the claim, so only one sweeper acts on it. Returns 0 if there is nothing
+# to do, 1 if the task should be requeued and 2 if it used up its attempts.
+EXPIRE_LEASE_SCRIPT = """
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then return 0 end
+if redis.call('HGET', KEYS[1], 'state') ~= 'processing' then return 0 end
+local attempts = tonumber(redis.call('HGET', KEYS[1], 'attempts') or '0')
+if attempts >= tonumber(ARGV[3]) then
+    redis.call('HSET', KEYS[1], 'state', 'dead_lettered', 'queue', ARGV[5])
+    return 2
+end
+redis.call('HSET', KEYS[1], 'state', 'queued', 'queue', ARGV[4], 'enqueued_at', ARGV[2])
+return 1
+"""
+
+LEASE_MISSING = 0
+LEASE_COMPLETED = -1
+LEASE_AT_CAPACITY = -2
+EXPIRED_REQUEUE = 1
+EXPIRED_DEAD_LETTER = 2
+
+# Keyed task index kept in Redis alongside the RabbitMQ queues. Every task has
+# one hash holding its state, payload, result and timestamps, so status, result
+# and completion lookups are O(1) instead of queue scans.
+class TaskStore:
+    def __init__(self, client, queue_ttl: float, retention: int):
+        # queue_ttl applies to tasks stored without one of their own
+        self.client = client
+        self.queue_ttl = queue_ttl
+        self.retention = retention
+        self._lease = client.register_script(LEASE_SCRIPT)
+        self._heartbeat = client.register_script(HEARTBEAT_SCRIPT)
+        self._expire_lease = client.register_script(EXPIRE_LEASE_SCRIPT)
+
+    async def create(self, task_id: str, task_type: str, payload: dict, queue: str, priority: str, tenant: str,
+                     queue_ttl: float) -> None:
+        key = task_key(task_id)
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping={
+            "task_type": task_type,
+            "priority": priority,
+            "tenant": tenant,
+            "state": TaskState.queued.value,
+            "queue": queue,
+            "payload": json.dumps(payload),
+            "submitted_at": now,
+            "enqueued_at": now,
+            "queue_ttl": queue_ttl,
+            "attempts": 0,
+        })
+        pipe.expire(key, self.retention)
+        await pipe.execute()
+
+    async def get(self, task_id: str) -> Optional[dict]:
+        return self._decode(await self.client.hgetall(task_key(task_id)))
+
+    async def get_many(self, task_ids: list[str]) -> list[Optional[dict]]:
+        pipe = self.client.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(task_key(task_id))
+        return [self._decode(raw) for raw in await pipe.execute()]
+
+    def _decode(self, raw: dict) -> Optional[dict]:
+        if not raw:
+            return None
+        record = {k.decode(): v.decode() for k, v in raw.items()}
+        for field in ("payload", "result"):
+            if field in record:
+                record[field] = json.loads(record[field])
+        for field in ("submitted_at", "enqueued_at", "queue_ttl", "fetched_at", "lease_expires_at", "completed_at"):
+            if field in record:
+                record[field] = float(record[field])
+        record["attempts"] = int(record.get("attempts", 0))
+        return record
+
+    async def lease(self, task_id: str, task_type: str, lease_timeout: float, max_concurrency: Optional[int] = None) -> tuple[int, float]:
+        # Returns the attempt number (or LEASE_MISSING / LEASE_COMPLETED /
+        # LEASE_AT_CAPACITY) and the lease deadline
+        now = time.time()
+        deadline = now + lease_timeout
+        attempt = await self._lease(keys=[task_key(task_id), leases_key(task_type)],
+                                    args=[task_id, now, deadline, max_concurrency or 0])
+        if attempt > 0:
+            await self.client.publish(events_channel(task_id), TaskState.processing.value)
+        return attempt, deadline
+
+    async def heartbeat(self, task_id: str, task_type: str, lease_timeout: float) -> Optional[float]:
+        # Returns the new lease deadline, or None if the lease is no longer held
+        deadline = time.time() + lease_timeout
+        if not await self._heartbeat(keys=[task_key(task_id), leases_key(task_type)], args=[task_id, deadline]):
+            return None
+        return deadline
+
+    async def leased_count(self, task_type: str) -> int:
+        return await self.client.zcard(leases_key(task_type))
+
+    async def expired_leases(self, task_type: str, limit: int) -> list[str]:
+        return [raw.decode() for raw in await self.client.zrangebyscore(leases_key(task_type), 0, time.time(), start=0, num=limit)]
+
+    async def expire_lease(self, task_id: str, task_type: str, max_attempts: int, queue: str, dlq: str) -> int:
+        outcome = await self._expire_lease(
+            keys=[task_key(task_id), leases_key(task_type)],
+            args=[task_id, time.time(), max_attempts, queue, dlq],
+        )
+        if outcome == EXPIRED_REQUEUE:
+            await self.client.publish(events_channel(task_id), TaskState.queued.value)
+        elif outcome == EXPIRED_DEAD_LETTER:
+            await self.client.publish(events_channel(task_id), TaskState.dead_lettered.value)
+        return outcome
+
+    async def restore_lease(self, task_id: str, task_type: str, retry_in: float) -> None:
+        # Puts a claimed lease back (as processing) so a later sweep retries it
+        deadline = time.time() + retry_in
+        pipe = self.client.pipeline()
+        pipe.hset(task_key(task_id), mapping={"state": TaskState.processing.value, "lease_expires_at": deadline})
+        pipe.zadd(leases_key(task_type), {task_id: deadline})
+        await pipe.execute()
+
+    async def complete(self, task_id: str, task_type: str, result: dict) -> None:
+        await self.complete_many(task_type, {task_id: result})
+
+    async def complete_many(self, task_type: str, results: dict[str, dict]) -> None:
+        if not results:
+            return
+        now = time.time()
+        pipe = self.client.pipeline()
+        for task_id, result in results.items():
+            key = task_key(task_id)
+            pipe.hset(key, mapping={
+                "state": TaskState.completed.value,
+                "queue": "",
+                "result": json.dumps(result),
+                "completed_at": now,
+            })
+            pipe.expire(key, self.retention)
+            pipe.zrem(leases_key(task_type), task_id)
+            pipe.publish(events_channel(task_id), TaskState.completed.value)
+        await pipe.execute()
+
+    def effective_state(self, record: Optional[dict], now: Optional[float] = None) -> TaskState:
+        # Leases are expired explicitly by the sweeper, but a queued message is
+        # dead-lettered by the task queue's TTL on its own, so derive that one
+        if record is None:
+            return TaskState.missing
+        state = TaskState(record["state"])
+        if state != TaskState.queued:
+            return state
+        now = time.time() if now is None else now
+        queue_ttl = record.get("queue_ttl", self.queue_ttl)
+        if now >= record.get("enqueued_at", record["submitted_at"]) + queue_ttl:
+            return TaskState.expired
+        return TaskState.queued
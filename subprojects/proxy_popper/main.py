@@ -1,55 +1,292 @@
 from fastapi import FastAPI
-import pika
-import requests
-import threading
+from prometheus_fastapi_instrumentator import Instrumentator
+from pydantic import ValidationError
+from typing import Optional
+import aio_pika
+import asyncio
+import httpx
 import json
-import os
 import time
+import os
+from shared.amqp import connect_async
+from shared import interfaces
+from shared.clients import origin
+from shared.memo import Uncacheable, memo, memoizable
+from shared.tracing import DOWNSTREAM_CALL, QUEUE_WAIT, SERIALIZATION, add_tracing, extract, inject, record, span, timed
 
 app = FastAPI()
+Instrumentator().instrument(app).expose(app)
+add_tracing(app)
 
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", 5672))
 SERVICE_NAME = os.getenv("SERVICE_NAME", "addition")  # e.g., 'addition' or 'subtraction'
 DOWNSTREAM_URL = os.getenv("DOWNSTREAM_URL", "http://addition:8000/add")  # Set via env
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", 1))  # max requests in flight to the downstream service
+DOWNSTREAM_TIMEOUT = float(os.getenv("DOWNSTREAM_TIMEOUT", 60))  # seconds
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 0))  # > 1 enables batched dispatch
+BATCH_WAIT_MS = float(os.getenv("BATCH_WAIT_MS", 5))
+BATCH_URL = os.getenv("BATCH_URL", f"{DOWNSTREAM_URL}/batch")
+# Request model of the downstream service in shared.interfaces, e.g.
+# AdditionRequest; its responses are memoized if the model sets `memoize`
+MEMO_INTERFACE = os.getenv("MEMO_INTERFACE", "")
+QUEUE_NAME = f"{SERVICE_NAME}_requests"
+DOWNSTREAM_HOST = origin(DOWNSTREAM_URL)
+BATCH_HOST = origin(BATCH_URL)
+interface = getattr(interfaces, MEMO_INTERFACE) if MEMO_INTERFACE else None
 
 # TODO: Add authentication if needed
 
-def process_queue():
-    while True:
+connection = None
+channel = None
+http_client = None
+
+async def reply(message: aio_pika.abc.AbstractIncomingMessage, status_code: int, body: bytes):
+    if not message.reply_to:
+        return
+    await channel.default_exchange.publish(
+        aio_pika.Message(
+            body=body,
+            correlation_id=message.correlation_id,
+            content_type='application/json',
+            headers={"status_code": status_code},
+        ),
+        routing_key=message.reply_to,
+    )
+
+async def fail(message: aio_pika.abc.AbstractIncomingMessage, status_code: int, body: bytes):
+    # Give the request one more attempt (possibly on another replica), then
+    # report the failure to the caller rather than retrying forever
+    if not message.redelivered:
+        await message.nack(requeue=True)
+        return
+    await reply(message, status_code, body)
+    await message.ack()
+
+def consumed(message: aio_pika.abc.AbstractIncomingMessage) -> Optional[tuple[str, str]]:
+    # Records how long the request sat in the queue, from the pusher's
+    # published_at, and returns the trace context to continue from
+    headers = message.headers or {}
+    parent = extract(headers)
+    published_at = headers.get("published_at")
+    if not isinstance(published_at, (int, float)):
+        return parent
+    QUEUE_WAIT.labels(QUEUE_NAME).observe(max(0.0, time.time() - published_at))
+    return record("queue wait", published_at, parent, queue=QUEUE_NAME).context
+
+def memo_key(message: aio_pika.abc.AbstractIncomingMessage) -> Optional[bytes]:
+    # The request as the interface serializes it, so equal requests match
+    # however they were formatted; None if it isn't memoized
+    if not memoizable(interface):
+        return None
+    try:
+        return interface.model_validate_json(message.body).model_dump_json().encode()
+    except ValidationError:
+        return None  # the downstream service reports what's wrong
+
+async def post(body: bytes) -> tuple[int, bytes]:
+    with span(f"POST {DOWNSTREAM_HOST}", histogram=DOWNSTREAM_CALL, labels=(DOWNSTREAM_HOST,)):
+        resp = await http_client.post(
+            DOWNSTREAM_URL,
+            content=body,
+            headers=inject({"Content-Type": "application/json"}),
+        )
+    return resp.status_code, resp.content
+
+async def post_memoized(body: bytes, key: bytes) -> tuple[int, bytes]:
+    # Only successful responses are stored; others still go to every
+    # requester coalesced onto the same call
+    async def call():
+        status_code, content = await post(body)
+        if status_code != 200:
+            raise Uncacheable((status_code, content))
+        return content
+    result = await memo.call(DOWNSTREAM_URL, key, call)
+    return result if isinstance(result, tuple) else (200, result)
+
+async def forward(message: aio_pika.abc.AbstractIncomingMessage, context: Optional[tuple[str, str]]):
+    # Forward the request to the real downstream API
+    with span(f"handle {SERVICE_NAME}", context):
+        key = memo_key(message)
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT))
-            break
-        except pika.exceptions.AMQPConnectionError:
-            print("Waiting for RabbitMQ in popper...")
-            time.sleep(2)
-    channel = connection.channel()
-    queue_name = f"{SERVICE_NAME}_requests"
-    channel.queue_declare(queue=queue_name)
-
-    def callback(ch, method, props, body):
-        data = json.loads(body)
-        # Forward the request to the real downstream API
-        resp = requests.post(DOWNSTREAM_URL, json=data)
-        resp_body = resp.json()
+            status_code, content = await (post(message.body) if key is None else post_memoized(message.body, key))
+        except httpx.HTTPError as e:
+            print(f"Downstream request to {DOWNSTREAM_URL} failed: {e!r}")
+            await fail(message, 502, b'{"error": "Downstream request failed"}')
+            return
+        if status_code >= 500:
+            await fail(message, status_code, content)
+            return
         # Publish the response to the reply queue
-        channel.basic_publish(
-            exchange='',
-            routing_key=props.reply_to,
-            properties=pika.BasicProperties(
-                correlation_id=props.correlation_id,
-                content_type='application/json',
-            ),
-            body=json.dumps(resp_body)
-        )
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        await reply(message, status_code, content)
+        await message.ack()
+
+async def on_message(message: aio_pika.abc.AbstractIncomingMessage):
+    await forward(message, consumed(message))
+
+async def answer_from_memo(messages, contexts) -> tuple[list, list, list]:
+    # Replies to the requests with a memoized response and returns the rest,
+    # with their memo keys
+    keys = [memo_key(m) for m in messages]
+    if not any(keys):
+        return messages, contexts, keys
+    cached = await asyncio.gather(*(memo.lookup(DOWNSTREAM_URL, k) for k in keys if k is not None))
+    hits = iter(cached)
+    results = [next(hits) if k is not None else None for k in keys]
+    answered = [(m, r) for m, r in zip(messages, results) if r is not None]
+    await asyncio.gather(*(reply(m, 200, r) for m, r in answered))
+    await asyncio.gather(*(m.ack() for m, _ in answered))
+    rest = [i for i, r in enumerate(results) if r is None]
+    return [messages[i] for i in rest], [contexts[i] for i in rest], [keys[i] for i in rest]
+
+async def answer_when_done(message: aio_pika.abc.AbstractIncomingMessage, context: Optional[tuple[str, str]],
+                           pending: asyncio.Future):
+    # Answers a request that joined an identical call in flight. If that call
+    # gave no response to reuse, the request is sent on its own.
+    try:
+        result = await asyncio.shield(pending)
+    except Exception:
+        result = None
+    if isinstance(result, bytes):
+        await reply(message, 200, result)
+        await message.ack()
+    else:
+        await forward(message, context)
+
+class BatchFailed(Exception):
+    # The batch request failed as a whole: connection error or 5xx
+    def __init__(self, status_code: int, body: bytes):
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.body = body
+
+async def post_batch(messages: list[aio_pika.abc.AbstractIncomingMessage],
+                     contexts: list[Optional[tuple[str, str]]]) -> Optional[list[bytes]]:
+    # One response per message, or None if the batch can't be answered as a
+    # whole and its messages should be sent one by one
+    # The batch joins the first request's trace and links the others
+    links = [f"{trace_id}-{span_id}" for trace_id, span_id in filter(None, contexts)]
+    with span(f"batch {SERVICE_NAME}", contexts[0], size=len(messages), links=links):
+        # Bodies are already JSON, so the batch request is just their concatenation
+        with timed(SERIALIZATION, "batch_encode"):
+            body = b"[" + b",".join(m.body for m in messages) + b"]"
+        try:
+            with span(f"POST {BATCH_HOST}", histogram=DOWNSTREAM_CALL, labels=(BATCH_HOST,)):
+                resp = await http_client.post(BATCH_URL, content=body, headers=inject({"Content-Type": "application/json"}))
+        except httpx.HTTPError as e:
+            print(f"Batch request to {BATCH_URL} failed: {e!r}")
+            raise BatchFailed(502, b'{"error": "Downstream request failed"}')
+        if resp.status_code >= 500:
+            raise BatchFailed(resp.status_code, resp.content)
+        if resp.status_code != 200:
+            # One bad item rejects the whole batch; send them one by one so only it fails
+            return None
+        with timed(SERIALIZATION, "batch_decode"):
+            try:
+                decoded = resp.json()
+            except ValueError:
+                decoded = None
+            results = [json.dumps(r).encode() for r in decoded] if isinstance(decoded, list) else []
+        if len(results) != len(messages):
+            # Not one response per request, so none can be matched up safely
+            print(f"Batch response from {BATCH_URL} doesn't match the {len(messages)} requests; sending them one by one")
+            return None
+        return results
+
+async def dispatch_batch(messages: list[aio_pika.abc.AbstractIncomingMessage], contexts: list[Optional[tuple[str, str]]]):
+    messages, contexts, keys = await answer_from_memo(messages, contexts)
+    # Identical requests, in this batch or in a call already in flight, wait
+    # for that one call instead of going downstream again. The others are
+    # registered as in flight until the batch is answered.
+    joined = []
+    batch = []
+    for message, context, key in zip(messages, contexts, keys):
+        pending = None if key is None else memo.join(DOWNSTREAM_URL, key)
+        if pending is not None:
+            joined.append(asyncio.ensure_future(answer_when_done(message, context, pending)))
+        else:
+            batch.append((message, context, key, None if key is None else memo.begin(DOWNSTREAM_URL, key)))
+    if batch:
+        await send_batch(batch)
+    await asyncio.gather(*joined)
+
+async def send_batch(batch: list[tuple]):
+    messages = [message for message, _, _, _ in batch]
+    contexts = [context for _, context, _, _ in batch]
+    calls = [(key, call) for _, _, key, call in batch if call is not None]
+    try:
+        results = await post_batch(messages, contexts)
+    except BaseException as e:
+        # Whoever joined these calls sends their request on its own
+        for key, call in calls:
+            await memo.end(DOWNSTREAM_URL, key, call, error=RuntimeError("Batch call failed"))
+        if not isinstance(e, BatchFailed):
+            raise
+        await asyncio.gather(*(fail(m, e.status_code, e.body) for m in messages))
+        return
+    if results is None:
+        # Ended first, or forward() would join the batch's own calls
+        for key, call in calls:
+            await memo.end(DOWNSTREAM_URL, key, call, error=RuntimeError("Batch not answered"))
+        await asyncio.gather(*(forward(m, c) for m, c in zip(messages, contexts)))
+        return
+    await asyncio.gather(*(memo.end(DOWNSTREAM_URL, key, call, value=result)
+                           for (_, _, key, call), result in zip(batch, results) if call is not None))
+    await asyncio.gather(*(reply(m, 200, r) for m, r in zip(messages, results)))
+    await asyncio.gather(*(m.ack() for m in messages))
+
+class Batcher:
+    # Collects messages until BATCH_SIZE are waiting or BATCH_WAIT_MS has passed
+    # since the first one, then dispatches them as one downstream request
+    def __init__(self, size: int, wait: float):
+        self.size = size
+        self.wait = wait
+        self.messages = []
+        self.contexts = []
+        self.timer = None
+        self.tasks = set()
+
+    async def add(self, message: aio_pika.abc.AbstractIncomingMessage):
+        self.messages.append(message)
+        self.contexts.append(consumed(message))
+        if len(self.messages) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.wait, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        messages, self.messages = self.messages, []
+        contexts, self.contexts = self.contexts, []
+        if messages:
+            task = asyncio.create_task(dispatch_batch(messages, contexts))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
 
-    channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=False)
-    channel.start_consuming()
+batcher = Batcher(BATCH_SIZE, BATCH_WAIT_MS / 1000)
 
 @app.on_event("startup")
-def start_background_worker():
-    t = threading.Thread(target=process_queue, daemon=True)
-    t.start()
+async def start_consumer():
+    global connection, channel, http_client
+    batching = BATCH_SIZE > 1
+    http_client = httpx.AsyncClient(
+        timeout=DOWNSTREAM_TIMEOUT,
+        limits=httpx.Limits(max_connections=PREFETCH_COUNT, max_keepalive_connections=PREFETCH_COUNT),
+    )
+    connection = await connect_async(RABBITMQ_HOST, RABBITMQ_PORT)
+    channel = await connection.channel()
+    # The broker hands us at most PREFETCH_COUNT unacked messages; each one is
+    # processed in its own task, so this is the popper's concurrency limit.
+    # When batching, allow PREFETCH_COUNT full batches in flight instead.
+    await channel.set_qos(prefetch_count=PREFETCH_COUNT * BATCH_SIZE if batching else PREFETCH_COUNT)
+    queue = await channel.declare_queue(f"{SERVICE_NAME}_requests")
+    await queue.consume(batcher.add if batching else on_message, no_ack=False)
 
-# TODO: Add error handling, timeouts, and connection pooling 
\ No newline at end of file
+@app.on_event("shutdown")
+async def stop_consumer():
+    if connection is not None:
+        await connection.close()
+    if http_client is not None:
+        await http_client.aclose()
@@ -1,63 +1,97 @@
 from fastapi import FastAPI, Request
-import pika
+from fastapi.responses import JSONResponse, Response
+from prometheus_fastapi_instrumentator import Instrumentator
+from typing import Optional
+import aio_pika
+import asyncio
+import time
 import uuid
-import json
 import os
-import time
+from shared.amqp import connect_async
+from shared.tracing import BROKER_RPC, add_tracing, inject, span
 
 app = FastAPI()
+Instrumentator().instrument(app).expose(app)
+add_tracing(app)
 
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", 5672))
+RPC_TIMEOUT = float(os.getenv("RPC_TIMEOUT", 60))  # seconds
 
 # TODO: Add authentication if needed
 
-@app.post("/proxy/{service}")
-async def proxy(service: str, request: Request):
-    body = await request.json()
-    correlation_id = str(uuid.uuid4())
-    reply_queue = f"reply_{correlation_id}"
+class RpcClient:
+    # One long-lived reply queue per process; responses are matched to waiting
+    # callers by correlation id, so any number of RPCs can be in flight at once.
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reply_queue_name = f"reply_{uuid.uuid4()}"
+        self.futures: dict[str, asyncio.Future] = {}
+        self.connection = None
+        self.channel = None
+
+    async def connect(self):
+        self.connection = await connect_async(self.host, self.port)
+        # Unroutable requests (no popper queue for the service) fail fast instead of timing out
+        self.channel = await self.connection.channel(on_return_raises=True)
+        reply_queue = await self.channel.declare_queue(self.reply_queue_name, exclusive=True, auto_delete=True)
+        await reply_queue.consume(self.on_response, no_ack=True)
+
+    async def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        if self.connection is not None:
+            await self.connection.close()
+
+    def on_response(self, message: aio_pika.abc.AbstractIncomingMessage):
+        future = self.futures.pop(message.correlation_id, None)
+        # Late replies for timed out or cancelled calls are dropped
+        if future is not None and not future.done():
+            status_code = (message.headers or {}).get("status_code", 200)
+            future.set_result((status_code, message.body))
 
-    # Retry logic for RabbitMQ connection
-    while True:
+    async def call(self, service: str, body: bytes, timeout: float) -> tuple[int, bytes]:
+        correlation_id = str(uuid.uuid4())
+        future = asyncio.get_running_loop().create_future()
+        self.futures[correlation_id] = future
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT))
-            break
-        except pika.exceptions.AMQPConnectionError:
-            print("Waiting for RabbitMQ in pusher...")
-            time.sleep(2)
-    channel = connection.channel()
-
-    # Declare reply queue (auto-delete)
-    channel.queue_declare(queue=reply_queue, exclusive=True, auto_delete=True)
-
-    # Publish request to service queue
-    channel.basic_publish(
-        exchange='',
-        routing_key=f"{service}_requests",
-        properties=pika.BasicProperties(
-            reply_to=reply_queue,
-            correlation_id=correlation_id,
-            content_type='application/json',
-        ),
-        body=json.dumps(body)
-    )
-
-    # Wait for response
-    response = None
-    def on_response(ch, method, props, body):
-        nonlocal response
-        if props.correlation_id == correlation_id:
-            response = json.loads(body)
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            ch.stop_consuming()
-
-    channel.basic_consume(queue=reply_queue, on_message_callback=on_response, auto_ack=False)
-    channel.start_consuming()
-
-    channel.queue_delete(queue=reply_queue)
-    connection.close()
-
-    return response
-
-# TODO: Add error handling, timeouts, and connection pooling 
\ No newline at end of file
+            with span(f"rpc {service}", histogram=BROKER_RPC, labels=(service,)):
+                await self.channel.default_exchange.publish(
+                    aio_pika.Message(
+                        body=body,
+                        correlation_id=correlation_id,
+                        reply_to=self.reply_queue_name,
+                        content_type='application/json',
+                        # Don't let a popper work on a request nobody is waiting for
+                        expiration=timeout,
+                        # The popper measures queue wait from published_at
+                        headers=inject({"published_at": time.time()}),
+                    ),
+                    routing_key=f"{service}_requests",
+                )
+                return await asyncio.wait_for(future, timeout)
+        finally:
+            self.futures.pop(correlation_id, None)
+
+rpc_client = RpcClient(RABBITMQ_HOST, RABBITMQ_PORT)
+
+@app.on_event("startup")
+async def connect_rpc_client():
+    await rpc_client.connect()
+
+@app.on_event("shutdown")
+async def close_rpc_client():
+    await rpc_client.close()
+
+@app.post("/proxy/{service}")
+async def proxy(service: str, request: Request, timeout: Optional[float] = None):
+    # The body is forwarded as-is; no need to parse and re-serialize it
+    body = await request.body()
+    try:
+        status_code, response = await rpc_client.call(service, body, timeout or RPC_TIMEOUT)
+    except asyncio.TimeoutError:
+        return JSONResponse(status_code=504, content={"error": f"Timed out waiting for {service}"})
+    except aio_pika.exceptions.DeliveryError:
+        return JSONResponse(status_code=502, content={"error": f"No queue for service {service}"})
+    return Response(content=response, status_code=status_code, media_type="application/json")
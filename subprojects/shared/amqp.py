@@ -0,0 +1,113 @@
+from contextlib import asynccontextmanager
+import asyncio
+import aio_pika
+import aiormq
+
+async def connect_async(host: str, port: int, retry_delay: float = 2) -> aio_pika.RobustConnection:
+    # Robust connections re-establish themselves (and their queues/consumers)
+    # after a drop; we only need to retry the initial connect
+    while True:
+        try:
+            return await aio_pika.connect_robust(host=host, port=port)
+        except (aio_pika.exceptions.AMQPConnectionError, OSError):
+            print(f"Waiting for RabbitMQ at {host}:{port}...")
+            await asyncio.sleep(retry_delay)
+
+class ChannelPool:
+    # Pool of channels on one robust connection. A channel is checked out by
+    # one task at a time, so a slow call doesn't hold up unrelated ones.
+    def __init__(self, host: str, port: int, size: int = 8, checkout_timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.connection = None
+        self._idle = asyncio.LifoQueue()
+        self._created = 0
+        self._declared = set()
+
+    async def start(self) -> None:
+        self.connection = await connect_async(self.host, self.port)
+
+    def _discard(self, channel) -> None:
+        self._created -= 1
+        if not channel.is_closed:
+            asyncio.ensure_future(channel.close())
+
+    async def _checkout(self):
+        while True:
+            try:
+                channel = self._idle.get_nowait()
+            except asyncio.QueueEmpty:
+                if self._created < self.size:
+                    self._created += 1
+                    try:
+                        return await self.connection.channel()
+                    except Exception:
+                        self._created -= 1
+                        raise
+                try:
+                    channel = await asyncio.wait_for(self._idle.get(), self.checkout_timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError("Timed out waiting for a RabbitMQ channel")
+            if not channel.is_closed:
+                return channel
+            self._discard(channel)
+
+    @asynccontextmanager
+    async def channel(self):
+        channel = await self._checkout()
+        try:
+            yield channel
+        except (aio_pika.exceptions.AMQPError, aio_pika.exceptions.ChannelInvalidStateError):
+            # A channel error closes the channel; drop it and forget what was
+            # declared, since the error may have been about a missing queue
+            self._discard(channel)
+            self._declared.clear()
+            channel = None
+            raise
+        finally:
+            if channel is not None:
+                self._idle.put_nowait(channel)
+
+    async def declare_queue(self, channel, queue: str, **kwargs) -> None:
+        # Queue declarations are broker-wide and idempotent, so only the first one matters
+        if queue in self._declared:
+            return
+        await channel.declare_queue(queue, **kwargs)
+        self._declared.add(queue)
+
+    async def get(self, channel, queue: str):
+        # basic.get: the next message of `queue` (to be acked), or None if it's empty
+        queue = await channel.get_queue(queue, ensure=False)
+        return await queue.get(no_ack=False, fail=False)
+
+    async def publish(self, channel, queue: str, message: aio_pika.Message) -> bool:
+        # Published as mandatory, so a message for a queue that doesn't exist
+        # (any more) comes back instead of being dropped; returns False then
+        result = await channel.default_exchange.publish(message, routing_key=queue, mandatory=True)
+        return not isinstance(result, aiormq.abc.DeliveredMessage)
+
+    def forget(self, queue: str) -> None:
+        # The queue was (or may have been) deleted; declare it again next time
+        self._declared.discard(queue)
+
+    async def delete_if_empty(self, channel, queue: str) -> bool:
+        # A queue that isn't empty is left alone. The count comes from the
+        # underlying channel, since the robust one answers a passive declare
+        # of a queue it declared from its cache.
+        underlay = await channel.get_underlay_channel()
+        declared = await underlay.queue_declare(queue, passive=True)
+        if declared.message_count:
+            return False
+        # if_empty still guards against a message published in between; the
+        # robust channel also stops re-declaring the queue on reconnect
+        await channel.queue_delete(queue, if_empty=True)
+        self.forget(queue)
+        return True
+
+    async def close(self) -> None:
+        while not self._idle.empty():
+            await self._idle.get_nowait().close()
+        if self.connection is not None:
+            await self.connection.close()
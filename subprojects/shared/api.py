@@ -1,23 +1,37 @@
 from functools import lru_cache
-from fastapi import FastAPI, Request
+from typing import Callable, get_type_hints
+from fastapi import FastAPI, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from prometheus_fastapi_instrumentator import Instrumentator
+from starlette.requests import ClientDisconnect
 import uuid
 import asyncio
+import os
 import redis.asyncio as redis
-import httpx
-import pickle
+from shared.clients import http_clients
+from shared.jobs import FINAL_STATES, JobExecutor, JobState, events_channel
+from shared.notify import SSE_KEEPALIVE, Notifier, next_message, sse_event
+from shared.results import ResultStore
+from shared.tracing import add_tracing, inject
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 
 # Create a Redis connection pool at module level
-redis_pool = redis.ConnectionPool(host='redis', port=6379, decode_responses=False)
+redis_pool = redis.ConnectionPool.from_url(REDIS_URL, decode_responses=False)
+result_store = ResultStore(redis.Redis(connection_pool=redis_pool))
+notifier = Notifier(redis.Redis(connection_pool=redis_pool))
+job_executor = JobExecutor(redis.Redis(connection_pool=redis_pool), result_store, notifier)
 
-# Set to keep strong references to background tasks
-background_tasks = set()
+LONG_POLL_MAX = float(os.getenv("LONG_POLL_MAX", 60))  # seconds
+SSE_KEEPALIVE_INTERVAL = 15  # seconds
 
 @lru_cache
 def get_app() -> FastAPI:
     app = FastAPI()
+    # /metrics serves the default prometheus_client registry, so metrics defined
+    # at module level elsewhere (shared/tracing.py, shared/memo.py, ...) show up too
     Instrumentator().instrument(app).expose(app)
     app.add_middleware(
         CORSMiddleware,
@@ -27,6 +41,17 @@ def get_app() -> FastAPI:
         allow_headers=["*"],
     )
 
+    @app.on_event("startup")
+    async def start_job_executor():
+        await notifier.start()
+        await job_executor.start(app)
+
+    @app.on_event("shutdown")
+    async def stop_job_executor():
+        await job_executor.stop()
+        await notifier.stop()
+        await http_clients.aclose()
+
     @app.middleware("http")
     async def handle_async_request(request: Request, call_next):
         if request.headers.get("X-Async-Request", "").lower() == "true":
@@ -37,58 +62,100 @@ def get_app() -> FastAPI:
             headers = dict(request.headers)
             headers.pop("x-async-request", None)  # Remove async header to avoid recursion
             webhook_url = headers.pop("x-async-webhook-url", None)
+            inject(headers)  # the job continues this request's trace
 
-            async def process_request():
-                async with httpx.AsyncClient() as client:
-                    response = await client.request(
-                        method,
-                        url,
-                        content=body,
-                        headers=headers,
-                        timeout=60
-                    )
-                    response_data = {
-                        'content': response.content,
-                        'status_code': response.status_code,
-                        'headers': dict(response.headers)
-                    }
-                    if webhook_url:
-                        # POST the result to the webhook URL
-                        await client.post(
-                            webhook_url,
-                            content=response.content,
-                            headers={**response_data['headers'], 'X-Async-Job-Id': job_id}
-                        )
-                    else:
-                        # Use Redis connection pool
-                        redis_client = redis.Redis(connection_pool=redis_pool)
-                        await redis_client.set(job_id, pickle.dumps(response_data))
-                        await redis_client.close()
-
-            task = asyncio.create_task(process_request())
-            
-            # Add the task to the set to keep it alive
-            # This is necessary because the task will be garbage collected if not kept alive
-            # https://docs.python.org/3/library/asyncio-task.html#creating-tasks
-            background_tasks.add(task)
-            task.add_done_callback(background_tasks.discard)
-            
+            if not await job_executor.submit(job_id, method, url, headers, body, webhook_url):
+                return JSONResponse(
+                    status_code=429,
+                    content={"error": "Too many async requests in flight"},
+                    headers={"Retry-After": "1"}
+                )
             return JSONResponse(content={"job_id": job_id})
 
         return await call_next(request)
 
+    # Added last so it wraps the async middleware too
+    add_tracing(app)
+
     @app.get("/job_result/{job_id}")
-    async def get_job_result(job_id: str):
-        redis_client = redis.Redis(connection_pool=redis_pool)
-        result = await redis_client.get(job_id)
-        await redis_client.close()
+    async def get_job_result(job_id: str, wait: float = Query(0, ge=0, le=LONG_POLL_MAX)):
+        result = await result_store.load(job_id)
+        if result is None:
+            if wait:
+                # Long-poll instead of making the client busy-poll
+                state = await job_executor.wait_for_state(job_id, wait)
+                if state is not None and state["state"] == JobState.done:
+                    result = await result_store.load(job_id)
         if result is None:
-            return JSONResponse(status_code=404, content={"error": "Result not found"})
-        response_data = pickle.loads(result)
-        return Response(
-            content=response_data['content'],
-            status_code=response_data['status_code'],
-            headers=response_data['headers']
+            state = await job_executor.get_state(job_id)
+            if state is None:
+                return JSONResponse(status_code=404, content={"error": "Result not found"})
+            if state["state"] == JobState.failed:
+                return JSONResponse(status_code=500, content={"job_id": job_id, **state})
+            # Queued, running, or delivered to a webhook
+            return JSONResponse(status_code=202, content={"job_id": job_id, **state})
+        headers = dict(result.headers)
+        if result.body is not None:
+            return Response(content=result.body, status_code=result.status_code, headers=headers)
+        return StreamingResponse(
+            result_store.iter_body(job_id, result),
+            status_code=result.status_code,
+            headers=headers
         )
 
-    return app
\ No newline at end of file
+    @app.get("/job_events/{job_id}")
+    async def get_job_events(job_id: str):
+        # Server-sent events: one "state" event per state change until the job
+        # finishes. The state is read again after every notification and every
+        # keepalive interval, so a missed notification only delays an event.
+        async def events():
+            async with notifier.subscribe(events_channel(job_id)) as updates:
+                last_state = None
+                while True:
+                    state = await job_executor.get_state(job_id)
+                    if state is None:
+                        yield sse_event("error", {"job_id": job_id, "error": "Job not found"})
+                        return
+                    if state != last_state:
+                        yield sse_event("state", {"job_id": job_id, **state})
+                        last_state = state
+                    if state["state"] in FINAL_STATES:
+                        return
+                    if await next_message(updates, SSE_KEEPALIVE_INTERVAL) is None:
+                        yield SSE_KEEPALIVE
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    return app
+
+def add_batch_route(app: FastAPI, path: str, endpoint: Callable) -> None:
+    # Expose a batch version of a single-item endpoint: it takes a list of the
+    # endpoint's request model and returns the list of responses, in order
+    hints = get_type_hints(endpoint)
+    response_type = hints.pop("return")
+    (request_type,) = hints.values()
+
+    if asyncio.iscoroutinefunction(endpoint):
+        async def batch_endpoint(requests: list[request_type]) -> list[response_type]:
+            return [await endpoint(r) for r in requests]
+    else:
+        async def batch_endpoint(requests: list[request_type]) -> list[response_type]:
+            # One threadpool hop for the whole batch rather than one per item
+            return await run_in_threadpool(lambda: [endpoint(r) for r in requests])
+
+    batch_endpoint.__name__ = f"{endpoint.__name__}_batch"
+    app.post(path)(batch_endpoint)
+
+class RequestStreamingResponse(StreamingResponse):
+    # For a body produced while the request body is still being read (from
+    # request.stream()). StreamingResponse would also listen for a disconnect
+    # on servers with ASGI < 2.4 (uvicorn), and that listener takes the
+    # request body's messages off receive(). A disconnect shows up as
+    # ClientDisconnect from request.stream() or from sending instead.
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.stream_response(send)
+        except OSError:
+            raise ClientDisconnect()
+        if self.background is not None:
+            await self.background()
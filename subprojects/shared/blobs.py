@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, Optional
+from urllib.parse import parse_qs, urlsplit
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import time
+
+# Content-addressed blobs on a volume shared by the services, so they can
+# pass a reference (and a byte range of it) instead of the bytes themselves
+BLOB_DIR = os.getenv("BLOB_DIR", "/blobs")
+BLOB_TTL = float(os.getenv("BLOB_TTL", 3600))  # seconds an unused blob is kept
+BLOB_WRITE_SIZE = 4 * 1024 * 1024  # bytes copied at a time when storing
+
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+class BlobNotFound(Exception):
+    pass
+
+@dataclass(frozen=True)
+class BlobRef:
+    # blob://sha256/<hex>, optionally ?offset=<bytes>&length=<bytes> for a range
+    digest: str
+    offset: int = 0
+    length: Optional[int] = None  # to the end of the blob if unset
+
+    def __str__(self) -> str:
+        ref = f"blob://sha256/{self.digest}"
+        if self.offset or self.length is not None:
+            ref += f"?offset={self.offset}" + ("" if self.length is None else f"&length={self.length}")
+        return ref
+
+    def slice(self, offset: int, length: int) -> "BlobRef":
+        # A range relative to this one
+        return BlobRef(self.digest, self.offset + offset, length)
+
+def parse_ref(value: str) -> BlobRef:
+    parts = urlsplit(value)
+    digest = parts.path.lstrip("/")
+    if parts.scheme != "blob" or parts.netloc != "sha256" or not DIGEST_PATTERN.fullmatch(digest):
+        raise ValueError(f"Invalid blob reference: {value}")
+    query = parse_qs(parts.query)
+    try:
+        offset = int(query.get("offset", ["0"])[0])
+        length = int(query["length"][0]) if "length" in query else None
+    except ValueError:
+        raise ValueError(f"Invalid blob range: {value}")
+    if offset < 0 or (length is not None and length < 0):
+        raise ValueError(f"Invalid blob range: {value}")
+    return BlobRef(digest, offset, length)
+
+class BlobStore:
+    def __init__(self, root: str = BLOB_DIR):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, "sha256", digest[:2], digest)
+
+    def put_file(self, f: BinaryIO) -> BlobRef:
+        # Blocking; copies `f` into the store, hashing it on the way. Content
+        # that is already stored is not written twice.
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+        hasher = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=os.path.join(self.root, "tmp"), delete=False) as tmp:
+            try:
+                while chunk := f.read(BLOB_WRITE_SIZE):
+                    hasher.update(chunk)
+                    tmp.write(chunk)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        digest = hasher.hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.unlink(tmp.name)
+            os.utime(path)  # keeps it from being pruned
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp.name, path)
+        return BlobRef(digest)
+
+    def size(self, ref: BlobRef) -> int:
+        # Size of the referenced range
+        try:
+            size = os.stat(self.path(ref.digest)).st_size
+        except FileNotFoundError:
+            raise BlobNotFound(str(ref))
+        if ref.offset > size or (ref.length is not None and ref.offset + ref.length > size):
+            raise ValueError(f"Range of {ref} is outside the blob ({size} bytes)")
+        return size - ref.offset if ref.length is None else ref.length
+
+    @contextmanager
+    def view(self, ref: BlobRef) -> Iterator[memoryview]:
+        # The referenced range as a read-only memoryview of the mapped file;
+        # only the pages that are read are loaded, and nothing is copied
+        try:
+            f = open(self.path(ref.digest), "rb")
+        except FileNotFoundError:
+            raise BlobNotFound(str(ref))
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            length = size - ref.offset if ref.length is None else ref.length
+            if ref.offset + length > size or length < 0:
+                raise ValueError(f"Range of {ref} is outside the blob ({size} bytes)")
+            if length == 0:
+                yield memoryview(b"")
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as whole:
+                    part = whole[ref.offset:ref.offset + length]
+                    try:
+                        yield part
+                    finally:
+                        part.release()
+
+    def prune(self, max_age: float = BLOB_TTL) -> int:
+        # Removes blobs not stored or re-stored within `max_age` seconds (and
+        # abandoned temp files); readers that already opened one are unaffected
+        cutoff = time.time() - max_age
+        removed = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+blob_store = BlobStore()
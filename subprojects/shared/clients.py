@@ -0,0 +1,101 @@
+from contextlib import asynccontextmanager
+from typing import Optional
+from urllib.parse import urlsplit
+from prometheus_client import Counter, Gauge
+import asyncio
+import os
+import httpx
+from shared.tracing import DOWNSTREAM_CALL, inject, span
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))  # per downstream host
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))  # seconds
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))  # seconds
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))  # seconds
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 2))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", 0.1))  # seconds, doubled per attempt
+
+IN_FLIGHT = Gauge("http_client_requests_in_flight", "Outgoing requests in flight", ["host"])
+POOL_MAX_CONNECTIONS = Gauge("http_client_pool_max_connections", "Connection limit of the pool", ["host"])
+RETRIES = Counter("http_client_retries_total", "Outgoing requests that were retried", ["host"])
+
+# Errors raised before the request reached the server; always safe to retry
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Errors and statuses that are only safe to retry for idempotent requests
+TRANSIENT_ERRORS = CONNECT_ERRORS + (httpx.ReadTimeout, httpx.RemoteProtocolError)
+TRANSIENT_STATUS = {502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+def origin(url: str) -> str:
+    parts = urlsplit(str(url))
+    return f"{parts.scheme}://{parts.netloc}"
+
+class ClientRegistry:
+    # One long-lived AsyncClient (and so one keep-alive connection pool) per
+    # downstream host, shared by every call site in the process
+    def __init__(self):
+        self.clients: dict[str, httpx.AsyncClient] = {}
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        host = origin(url)
+        client = self.clients.get(host)
+        if client is None:
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            )
+            self.clients[host] = client
+            POOL_MAX_CONNECTIONS.labels(host=host).set(HTTP_MAX_CONNECTIONS)
+        return client
+
+    async def request(self, method: str, url: str, idempotent: Optional[bool] = None, **kwargs) -> httpx.Response:
+        # Retries with exponential backoff: connection failures always, timeouts
+        # and 502/503/504 only when the request is idempotent
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        client = self.get(url)
+        host = origin(url)
+        attempt = 0
+        with span(f"{method} {host}", histogram=DOWNSTREAM_CALL, labels=(host,), url=str(url)) as call:
+            kwargs["headers"] = inject(dict(kwargs.get("headers") or {}))
+            while True:
+                IN_FLIGHT.labels(host=host).inc()
+                try:
+                    response = await client.request(method, url, **kwargs)
+                except (TRANSIENT_ERRORS if idempotent else CONNECT_ERRORS):
+                    if attempt >= HTTP_RETRIES:
+                        raise
+                else:
+                    if not (idempotent and response.status_code in TRANSIENT_STATUS and attempt < HTTP_RETRIES):
+                        call.attributes.update(status_code=response.status_code, attempts=attempt + 1)
+                        return response
+                    await response.aclose()
+                finally:
+                    IN_FLIGHT.labels(host=host).dec()
+                RETRIES.labels(host=host).inc()
+                await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** attempt)
+                attempt += 1
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        host = origin(url)
+        IN_FLIGHT.labels(host=host).inc()
+        try:
+            # Covers the whole exchange, until the caller has read the body
+            with span(f"{method} {host}", histogram=DOWNSTREAM_CALL, labels=(host,), url=str(url)) as call:
+                kwargs["headers"] = inject(dict(kwargs.get("headers") or {}))
+                async with self.get(url).stream(method, url, **kwargs) as response:
+                    call.attributes["status_code"] = response.status_code
+                    yield response
+        finally:
+            IN_FLIGHT.labels(host=host).dec()
+
+    async def aclose(self):
+        clients, self.clients = self.clients, {}
+        await asyncio.gather(*(client.aclose() for client in clients.values()))
+
+http_clients = ClientRegistry()
@@ -1,6 +1,11 @@
+from typing import ClassVar
 from pydantic import BaseModel
 
+# Request models with `memoize` set describe pure calls: the same request
+# always gets the same response, so callers may reuse it (see shared/memo.py)
+
 class SubtractionRequest(BaseModel):
+    memoize: ClassVar[bool] = True
     a: float
     b: float
 
@@ -8,6 +13,7 @@ class SubtractionResponse(BaseModel):
     result: float
 
 class AdditionRequest(BaseModel):
+    memoize: ClassVar[bool] = True
     a: float
     b: float
 
@@ -20,4 +26,8 @@ class WaitRequest(BaseModel):
 class WaitResponse(BaseModel):
     waited: bool
     start_time: str
-    end_time: str
\ No newline at end of file
+    end_time: str
+
+class HashRefRequest(BaseModel):
+    memoize: ClassVar[bool] = True  # a blob reference pins the content
+    ref: str  # blob://sha256/<hex>, optionally with a range
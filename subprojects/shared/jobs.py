@@ -0,0 +1,218 @@
+from enum import Enum
+from typing import Optional
+import asyncio
+import json
+import os
+import socket
+import httpx
+from shared.clients import http_clients
+from shared.notify import Notifier, next_message
+from shared.results import RESULT_TTL, ResultStore
+from shared.tracing import extract, inject, span
+
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY", 16))  # jobs running at once
+ASYNC_MAX_QUEUED = int(os.getenv("ASYNC_MAX_QUEUED", 1000))  # jobs waiting before we answer 429
+ASYNC_DISPATCH = os.getenv("ASYNC_DISPATCH", "inprocess")  # "inprocess" or "http"
+ASYNC_JOB_TIMEOUT = float(os.getenv("ASYNC_JOB_TIMEOUT", 60))  # seconds
+# Pending jobs are recorded per instance so a restarted instance picks up its
+# own unfinished work; defaults to the hostname, which is stable per container
+ASYNC_INSTANCE_ID = os.getenv("ASYNC_INSTANCE_ID", socket.gethostname())
+
+class JobState(str, Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+FINAL_STATES = {JobState.done, JobState.failed}
+
+def state_key(job_id: str) -> str:
+    return f"job:{job_id}:state"
+
+def request_key(job_id: str) -> str:
+    return f"job:{job_id}:request"
+
+def pending_key(instance_id: str) -> str:
+    return f"async_jobs:pending:{instance_id}"
+
+def events_channel(job_id: str) -> str:
+    return f"job:{job_id}:events"
+
+class JobExecutor:
+    # Runs async requests on a fixed number of workers fed by a bounded queue.
+    # Requests are persisted in Redis until they finish, so jobs that were
+    # queued or running when the process stopped are re-run on restart.
+    def __init__(self, client, result_store: ResultStore, notifier: Notifier, max_concurrency: int = ASYNC_MAX_CONCURRENCY,
+                 max_queued: int = ASYNC_MAX_QUEUED, dispatch: str = ASYNC_DISPATCH):
+        self.client = client
+        self.result_store = result_store
+        self.notifier = notifier
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.dispatch = dispatch
+        self.pending = pending_key(ASYNC_INSTANCE_ID)
+        self.queue = None
+        self.reserved = 0  # queue slots taken by submits still writing to Redis
+        self.workers = []
+        self.local_client = None
+        self.submitted = set()  # jobs submitted before the recovery snapshot, not to be recovered
+
+    async def start(self, app) -> None:
+        self.queue = asyncio.Queue(maxsize=self.max_queued)
+        if self.dispatch == "inprocess":
+            # Call the app directly through ASGI instead of looping back over
+            # the network. ASGITransport reads the whole response into memory
+            # before returning it, so results aren't streamed in this mode.
+            self.local_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), timeout=ASYNC_JOB_TIMEOUT)
+        self.submitted = set()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+        # Recovery waits for Redis in the background, so the service starts without it
+        self.workers.append(asyncio.create_task(self._recover()))
+
+    async def stop(self) -> None:
+        # Unfinished jobs stay in the pending list and are picked up on restart
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.local_client is not None:
+            await self.local_client.aclose()
+
+    async def submit(self, job_id: str, method: str, url: str, headers: dict, body: bytes,
+                     webhook_url: Optional[str] = None) -> bool:
+        # Returns False without queueing when the executor is saturated. The
+        # slot is reserved before the first await, so concurrent submits can't
+        # both take the last one.
+        if self.queue.qsize() + self.reserved >= self.max_queued:
+            return False
+        self.reserved += 1
+        if self.submitted is not None:
+            self.submitted.add(job_id)
+        pipe = self.client.pipeline()
+        pipe.hset(request_key(job_id), mapping={
+            "method": method,
+            "url": url,
+            "headers": json.dumps(headers),
+            "body": body,
+            "webhook_url": webhook_url or "",
+        })
+        pipe.expire(request_key(job_id), RESULT_TTL)
+        pipe.set(state_key(job_id), json.dumps({"state": JobState.queued}), ex=RESULT_TTL)
+        pipe.rpush(self.pending, job_id)
+        try:
+            await pipe.execute()
+        finally:
+            self.reserved -= 1
+        try:
+            self.queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            # Recovered jobs don't reserve, so they can still take the slot
+            await self._discard(job_id)
+            return False
+        return True
+
+    async def _discard(self, job_id: str) -> None:
+        # Undoes submit's writes for a job that wasn't queued
+        pipe = self.client.pipeline()
+        pipe.delete(request_key(job_id), state_key(job_id))
+        pipe.lrem(self.pending, 0, job_id)
+        try:
+            await pipe.execute()
+        except Exception as e:
+            print(f"Could not discard async job {job_id}: {e!r}")
+
+    async def get_state(self, job_id: str) -> Optional[dict]:
+        raw = await self.client.get(state_key(job_id))
+        return None if raw is None else json.loads(raw)
+
+    async def wait_for_state(self, job_id: str, timeout: float) -> Optional[dict]:
+        # Long-poll: returns as soon as the job finishes, or its state at the timeout
+        async with self.notifier.subscribe(events_channel(job_id)) as events:
+            state = await self.get_state(job_id)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while state is not None and state["state"] not in FINAL_STATES:
+                message = await next_message(events, deadline - loop.time())
+                if message is None:
+                    break
+                state = json.loads(message)
+        return state
+
+    async def _set_state(self, job_id: str, state: JobState, **extra) -> None:
+        payload = json.dumps({"state": state, **extra})
+        await self.client.set(state_key(job_id), payload, ex=RESULT_TTL)
+        await self.notifier.publish(events_channel(job_id), payload)
+
+    async def _recover(self) -> None:
+        while True:
+            try:
+                job_ids = [raw_id.decode() for raw_id in await self.client.lrange(self.pending, 0, -1)]
+                break
+            except Exception as e:
+                print(f"Could not read pending async jobs, retrying: {e!r}")
+                await asyncio.sleep(1)
+        # Jobs submitted since start are already queued (or were rejected)
+        job_ids = [job_id for job_id in job_ids if job_id not in self.submitted]
+        self.submitted = None
+        for job_id in job_ids:
+            # Waits for room in the queue rather than dropping recovered jobs
+            await self.queue.put(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self.queue.get()
+            try:
+                # The in-process transport ignores httpx timeouts, so the job as
+                # a whole is bounded here
+                await asyncio.wait_for(self._run(job_id), ASYNC_JOB_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = f"Timed out after {ASYNC_JOB_TIMEOUT:g}s" if isinstance(e, asyncio.TimeoutError) else str(e)
+                print(f"Async job {job_id} failed: {e!r}")
+                try:
+                    await self._set_state(job_id, JobState.failed, error=error)
+                except Exception as e:
+                    print(f"Could not record the failure of async job {job_id}: {e!r}")
+            finally:
+                self.queue.task_done()
+            # A Redis error here must not end the worker
+            try:
+                await self.client.lrem(self.pending, 0, job_id)
+                await self.client.delete(request_key(job_id))
+            except Exception as e:
+                print(f"Could not clean up async job {job_id}: {e!r}")
+
+    async def _run(self, job_id: str) -> None:
+        raw = await self.client.hgetall(request_key(job_id))
+        if not raw:
+            return
+        request = {k.decode(): v for k, v in raw.items()}
+        method = request["method"].decode()
+        url = request["url"].decode()
+        headers = json.loads(request["headers"])
+        webhook_url = request["webhook_url"].decode()
+        await self._set_state(job_id, JobState.running)
+
+        client = self.local_client if self.local_client is not None else http_clients
+        with span("async job", extract(headers), job_id=job_id):
+            inject(headers)
+            if webhook_url:
+                response = await client.request(method, url, content=request["body"], headers=headers, timeout=ASYNC_JOB_TIMEOUT)
+                # POST the result to the webhook URL
+                await http_clients.request(
+                    "POST",
+                    webhook_url,
+                    content=response.content,
+                    headers={**dict(response.headers), 'X-Async-Job-Id': job_id}
+                )
+            else:
+                # Stream the response into the result store chunk by chunk
+                async with client.stream(method, url, content=request["body"], headers=headers, timeout=ASYNC_JOB_TIMEOUT) as response:
+                    await self.result_store.save(
+                        job_id,
+                        response.status_code,
+                        response.headers.multi_items(),
+                        response.aiter_bytes()
+                    )
+        await self._set_state(job_id, JobState.done)
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+from prometheus_client import Counter
+import asyncio
+import hashlib
+import os
+import time
+import redis.asyncio as redis
+
+# Results of pure downstream calls, keyed by the call's namespace (usually
+# its URL) and canonical request. Only request models that set `memoize`
+# (see shared/interfaces.py) go through here.
+MEMO_SIZE = int(os.getenv("MEMO_SIZE", 10000))  # in-process entries, 0 disables the local tier
+MEMO_TTL = float(os.getenv("MEMO_TTL", 300))  # seconds a result is reused, 0 disables memoization
+MEMO_REDIS_URL = os.getenv("MEMO_REDIS_URL", "")  # shared tier across instances, off if unset
+
+HITS = Counter("memo_hits_total", "Memoized calls answered without calling downstream", ["namespace", "tier"])
+MISSES = Counter("memo_misses_total", "Memoized calls that went downstream", ["namespace"])
+
+def memoizable(model) -> bool:
+    return MEMO_TTL > 0 and getattr(model, "memoize", False)
+
+class Uncacheable(Exception):
+    # Raised by a memoized call whose value should be returned (to its caller
+    # and any coalesced ones) but not stored, e.g. an error response
+    def __init__(self, value: Any):
+        super().__init__()
+        self.value = value
+
+class Memo:
+    # In-process LRU in front of an optional Redis tier, with single-flight:
+    # concurrent identical calls share one downstream call. Values are bytes.
+    def __init__(self, size: int = MEMO_SIZE, ttl: float = MEMO_TTL, client=None):
+        self.size = size
+        self.ttl = ttl
+        self.client = client
+        self.entries: OrderedDict[bytes, tuple[float, bytes]] = OrderedDict()
+        self.in_flight: dict[bytes, asyncio.Future] = {}
+
+    @staticmethod
+    def key(namespace: str, request: bytes) -> bytes:
+        return hashlib.sha256(namespace.encode() + b"\0" + request).digest()
+
+    def _redis_key(self, key: bytes) -> str:
+        return f"memo:{key.hex()}"
+
+    async def lookup(self, namespace: str, request: bytes) -> Optional[bytes]:
+        key = self.key(namespace, request)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                HITS.labels(namespace, "local").inc()
+                return entry[1]
+            del self.entries[key]
+        if self.client is not None:
+            try:
+                value = await self.client.get(self._redis_key(key))
+            except redis.RedisError as e:
+                print(f"Memo lookup failed: {e!r}")
+                value = None
+            if value is not None:
+                self._remember(key, value)
+                HITS.labels(namespace, "redis").inc()
+                return value
+        return None
+
+    async def store(self, namespace: str, request: bytes, value: bytes) -> None:
+        key = self.key(namespace, request)
+        self._remember(key, value)
+        if self.client is not None:
+            try:
+                await self.client.set(self._redis_key(key), value, ex=max(1, int(self.ttl)))
+            except redis.RedisError as e:
+                print(f"Memo store failed: {e!r}")
+
+    def _remember(self, key: bytes, value: bytes) -> None:
+        if self.size <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    async def call(self, namespace: str, request: bytes, fn: Callable[[], Awaitable[bytes]]) -> Any:
+        # The stored value, or fn's (joining an identical call already in
+        # flight instead of starting another). Failures aren't stored.
+        value = await self.lookup(namespace, request)
+        if value is not None:
+            return value
+        key = self.key(namespace, request)
+        pending = self.in_flight.get(key)
+        if pending is None:
+            MISSES.labels(namespace).inc()
+            # Its own task, so a caller that is cancelled doesn't fail the others
+            pending = asyncio.ensure_future(self._fill(namespace, request, fn))
+            self.in_flight[key] = pending
+            pending.add_done_callback(lambda task: self._done(key, task))
+        else:
+            HITS.labels(namespace, "in_flight").inc()
+        return await asyncio.shield(pending)
+
+    def join(self, namespace: str, request: bytes) -> Optional[asyncio.Future]:
+        # The identical call in flight, if any, to wait on (through
+        # asyncio.shield); its result is what call() would have returned
+        pending = self.in_flight.get(self.key(namespace, request))
+        if pending is not None:
+            HITS.labels(namespace, "in_flight").inc()
+        return pending
+
+    def begin(self, namespace: str, request: bytes) -> asyncio.Future:
+        # For callers that make the call themselves, e.g. as one item of a
+        # batch: identical calls join the returned future until end()
+        key = self.key(namespace, request)
+        MISSES.labels(namespace).inc()
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        return future
+
+    async def end(self, namespace: str, request: bytes, future: asyncio.Future, value: Optional[bytes] = None,
+                  error: Optional[BaseException] = None) -> None:
+        # Finishes a call started with begin(); a value is stored, an error isn't
+        key = self.key(namespace, request)
+        if self.in_flight.get(key) is future:
+            del self.in_flight[key]
+        if error is not None:
+            future.set_exception(error)
+            future.exception()  # retrieved here, so it isn't reported if nobody joined
+            return
+        future.set_result(value)
+        await self.store(namespace, request, value)
+
+    async def _fill(self, namespace: str, request: bytes, fn: Callable[[], Awaitable[bytes]]) -> Any:
+        try:
+            value = await fn()
+        except Uncacheable as e:
+            return e.value
+        await self.store(namespace, request, value)
+        return value
+
+    def _done(self, key: bytes, task: asyncio.Task) -> None:
+        del self.in_flight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here, so it isn't reported if every caller left
+
+memo = Memo(client=redis.Redis.from_url(MEMO_REDIS_URL) if MEMO_REDIS_URL else None)
@@ -0,0 +1,132 @@
+from contextlib import asynccontextmanager
+from typing import Optional
+import asyncio
+import json
+import uuid
+
+SUBSCRIBE_TIMEOUT = 5  # seconds to wait for Redis to confirm a subscription
+
+class Notifier:
+    # Fans Redis pub/sub messages out to in-process waiters over a single
+    # subscriber connection, so thousands of long-polls cost one connection
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = None
+        self.reader = None
+        self.waiters: dict[str, set[asyncio.Queue]] = {}
+        # Channels we are subscribed to, each with a future resolved once Redis
+        # confirms the subscription. Changes are made under the lock, so
+        # SUBSCRIBE and UNSUBSCRIBE for a channel go out in the order decided.
+        self.subscribed: dict[str, asyncio.Future] = {}
+        self.unsubscribing: dict[str, int] = {}  # UNSUBSCRIBEs not yet confirmed
+        self.lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        # Subscribe confirmations are needed to tell when a subscription is active
+        self.pubsub = self.client.pubsub()
+        # Connects in the background, so the service starts while Redis is down
+        self.reader = asyncio.create_task(self._read())
+
+    async def stop(self) -> None:
+        if self.reader is not None:
+            self.reader.cancel()
+            await asyncio.gather(self.reader, return_exceptions=True)
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+
+    async def publish(self, channel: str, message: str) -> None:
+        await self.client.publish(channel, message)
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str):
+        # Subscribe before checking current state, then wait on the queue;
+        # that way a notification sent in between is never missed
+        queue = asyncio.Queue()
+        self.waiters.setdefault(channel, set()).add(queue)
+        try:
+            await self._update(channel)
+            # Sending SUBSCRIBE isn't enough: the state read goes over another
+            # connection, so wait until Redis confirms the subscription. If
+            # that takes too long, go on; callers re-read the state periodically.
+            confirmed = self.subscribed.get(channel)
+            if confirmed is not None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(confirmed), SUBSCRIBE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    print(f"Notifier subscription to {channel} not confirmed")
+            yield queue
+        finally:
+            waiters = self.waiters.get(channel, set())
+            waiters.discard(queue)
+            if not waiters:
+                self.waiters.pop(channel, None)
+                await self._update(channel)
+
+    async def _update(self, channel: str) -> None:
+        # Brings the Redis subscription in line with whether anyone is waiting
+        # now, which may have changed while waiting for the lock
+        async with self.lock:
+            if self.waiters.get(channel) and channel not in self.subscribed:
+                self.subscribed[channel] = asyncio.get_running_loop().create_future()
+                await self.pubsub.subscribe(channel)
+            elif not self.waiters.get(channel) and channel in self.subscribed:
+                del self.subscribed[channel]
+                self.unsubscribing[channel] = self.unsubscribing.get(channel, 0) + 1
+                await self.pubsub.unsubscribe(channel)
+
+    def _confirmed(self, kind: str, channel: str) -> None:
+        if kind == "unsubscribe":
+            if self.unsubscribing.get(channel, 0) > 1:
+                self.unsubscribing[channel] -= 1
+            else:
+                self.unsubscribing.pop(channel, None)
+        elif kind == "subscribe" and not self.unsubscribing.get(channel):
+            # With an UNSUBSCRIBE still pending this confirms an earlier SUBSCRIBE
+            confirmed = self.subscribed.get(channel)
+            if confirmed is not None and not confirmed.done():
+                confirmed.set_result(None)
+
+    async def _connect(self) -> None:
+        # A private channel keeps the connection subscribed while nobody is waiting
+        channel = f"notifier:{uuid.uuid4()}"
+        while True:
+            try:
+                async with self.lock:
+                    await self.pubsub.subscribe(channel)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Notifier could not connect to Redis: {e!r}")
+                await asyncio.sleep(1)
+
+    async def _read(self) -> None:
+        await self._connect()
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Notifier lost its Redis subscription: {e!r}")
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            channel = message["channel"].decode()
+            if message["type"] != "message":
+                self._confirmed(message["type"], channel)
+                continue
+            for queue in self.waiters.get(channel, ()):
+                queue.put_nowait(message["data"])
+
+async def next_message(queue: asyncio.Queue, timeout: float) -> Optional[bytes]:
+    try:
+        return await asyncio.wait_for(queue.get(), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+SSE_KEEPALIVE = ": keepalive\n\n"
@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+import json
+import os
+import struct
+import zlib
+
+RESULT_TTL = int(os.getenv("ASYNC_RESULT_TTL", 3600))  # seconds a result is kept
+RESULT_CHUNK_SIZE = int(os.getenv("ASYNC_RESULT_CHUNK_SIZE", 256 * 1024))  # bytes per Redis value
+RESULT_COMPRESSION = os.getenv("ASYNC_RESULT_COMPRESSION", "zlib")  # "zlib" or "none"
+COMPRESS_MIN_SIZE = 1024  # smaller bodies aren't worth compressing
+
+# Envelope: version, flags, status code, chunk count, header length, then the
+# headers as JSON pairs and, when the body fits in one chunk, the body itself
+ENVELOPE = struct.Struct("!BBHII")
+ENVELOPE_VERSION = 1
+FLAG_COMPRESSED = 1
+
+# The stored body is already decoded and re-framed when served
+SKIPPED_HEADERS = {"content-length", "content-encoding", "transfer-encoding", "connection"}
+
+def envelope_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+def chunk_key(job_id: str, index: int) -> str:
+    return f"job:{job_id}:chunk:{index}"
+
+@dataclass
+class StoredResult:
+    status_code: int
+    headers: list[tuple[str, str]]
+    body: Optional[bytes]  # set when the body was stored inline
+    chunk_count: int
+    compressed: bool
+
+class ResultStore:
+    # Async job results in Redis. Every key expires after RESULT_TTL, large
+    # bodies are split into chunks that can be written and served as streams,
+    # and the envelope is written last so a result is never seen half-stored.
+    def __init__(self, client, ttl: int = RESULT_TTL, chunk_size: int = RESULT_CHUNK_SIZE, compression: str = RESULT_COMPRESSION):
+        self.client = client
+        self.ttl = ttl
+        self.chunk_size = chunk_size
+        self.compress = compression == "zlib"
+
+    def _encode(self, data: bytes) -> bytes:
+        return zlib.compress(data, 1) if self.compress else data
+
+    async def save(self, job_id: str, status_code: int, headers: list[tuple[str, str]], body: AsyncIterator[bytes]) -> None:
+        buffer = bytearray()
+        chunk_count = 0
+        async for data in body:
+            buffer += data
+            while len(buffer) >= self.chunk_size:
+                await self.client.set(chunk_key(job_id, chunk_count), self._encode(bytes(buffer[:self.chunk_size])), ex=self.ttl)
+                del buffer[:self.chunk_size]
+                chunk_count += 1
+        if chunk_count and buffer:
+            await self.client.set(chunk_key(job_id, chunk_count), self._encode(bytes(buffer)), ex=self.ttl)
+            chunk_count += 1
+        inline = b"" if chunk_count else bytes(buffer)
+        compressed = self.compress and (chunk_count > 0 or len(inline) >= COMPRESS_MIN_SIZE)
+        if compressed and not chunk_count:
+            inline = zlib.compress(inline, 1)
+        header_bytes = json.dumps([(k, v) for k, v in headers if k.lower() not in SKIPPED_HEADERS]).encode()
+        envelope = ENVELOPE.pack(
+            ENVELOPE_VERSION,
+            FLAG_COMPRESSED if compressed else 0,
+            status_code,
+            chunk_count,
+            len(header_bytes),
+        )
+        await self.client.set(envelope_key(job_id), envelope + header_bytes + inline, ex=self.ttl)
+
+    async def load(self, job_id: str) -> Optional[StoredResult]:
+        raw = await self.client.get(envelope_key(job_id))
+        if raw is None:
+            return None
+        version, flags, status_code, chunk_count, header_length = ENVELOPE.unpack_from(raw)
+        offset = ENVELOPE.size
+        headers = [tuple(pair) for pair in json.loads(raw[offset:offset + header_length])]
+        compressed = bool(flags & FLAG_COMPRESSED)
+        body = None
+        if not chunk_count:
+            body = raw[offset + header_length:]
+            if compressed:
+                body = zlib.decompress(body)
+        return StoredResult(status_code, headers, body, chunk_count, compressed)
+
+    async def iter_body(self, job_id: str, result: StoredResult) -> AsyncIterator[bytes]:
+        # Fetches one chunk at a time, so serving a result holds one chunk in memory
+        if result.body is not None:
+            yield result.body
+            return
+        for index in range(result.chunk_count):
+            data = await self.client.get(chunk_key(job_id, index))
+            if data is None:
+                raise LookupError(f"Chunk {index} of job {job_id} has expired")
+            yield zlib.decompress(data) if result.compressed else data
@@ -0,0 +1,171 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Mapping, Optional
+from prometheus_client import Histogram
+import json
+import os
+import re
+import secrets
+import socket
+import sys
+import time
+
+# W3C trace context: https://www.w3.org/TR/trace-context/
+TRACEPARENT = "traceparent"
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")  # finished spans are appended here as JSON lines
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", socket.gethostname())
+TRACEPARENT_PATTERN = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}")
+
+QUEUE_WAIT = Histogram("queue_wait_seconds", "Time a message spent in a queue before it was consumed", ["queue"])
+BROKER_RPC = Histogram("broker_rpc_seconds", "Round trip of a request through the message broker", ["service"])
+DOWNSTREAM_CALL = Histogram("downstream_call_seconds", "Duration of outgoing HTTP calls", ["host"])
+SERIALIZATION = Histogram(
+    "serialization_seconds",
+    "Time spent encoding and decoding payloads",
+    ["operation"],
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+)
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float  # epoch seconds
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @property
+    def context(self) -> tuple[str, str]:
+        return self.trace_id, self.span_id
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def parse_traceparent(value: Optional[str]) -> Optional[tuple[str, str]]:
+    # (trace id, parent span id), or None for a missing or malformed header
+    match = TRACEPARENT_PATTERN.fullmatch((value or "").strip().lower())
+    if match is None or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return match.group(1), match.group(2)
+
+def extract(headers: Optional[Mapping]) -> Optional[tuple[str, str]]:
+    if not headers:
+        return None
+    value = headers.get(TRACEPARENT)
+    return parse_traceparent(value.decode() if isinstance(value, bytes) else value)
+
+def inject(headers: dict) -> dict:
+    # Adds the current span's context to outgoing headers (HTTP or AMQP)
+    span = current_span.get()
+    if span is not None:
+        headers[TRACEPARENT] = span.traceparent
+    return headers
+
+def new_span(name: str, parent: Optional[tuple[str, str]] = None, start: Optional[float] = None, **attributes) -> Span:
+    # A child of `parent`, else of the current span, else the root of a new trace
+    if parent is None and current_span.get() is not None:
+        parent = current_span.get().context
+    trace_id, parent_id = parent if parent is not None else (secrets.token_hex(16), None)
+    return Span(name, trace_id, secrets.token_hex(8), parent_id, time.time() if start is None else start, attributes)
+
+@contextmanager
+def span(name: str, parent: Optional[tuple[str, str]] = None, histogram: Optional[Histogram] = None,
+         labels: tuple = (), **attributes):
+    # Makes a span current for the duration of the block; its duration is also
+    # observed on `histogram` if given
+    current = new_span(name, parent, **attributes)
+    token = current_span.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.attributes["error"] = repr(e)
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        current_span.reset(token)
+        if histogram is not None:
+            histogram.labels(*labels).observe(duration)
+        export(current, duration)
+
+def record(name: str, start: float, parent: Optional[tuple[str, str]] = None, **attributes) -> Span:
+    # A span that already happened, from `start` (epoch seconds) until now,
+    # e.g. the time a message sat in a queue
+    finished = new_span(name, parent, start, **attributes)
+    export(finished, max(0.0, time.time() - start))
+    return finished
+
+@contextmanager
+def timed(histogram: Histogram, *labels):
+    # Histogram only, for steps too small to be worth a span
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter() - started)
+
+_export_file = None
+
+def export(finished: Span, duration: float) -> None:
+    global _export_file
+    if not TRACE_EXPORT_FILE:
+        return
+    if _export_file is None:
+        # Line buffered, so each span is one append; several processes can share the file
+        _export_file = open(TRACE_EXPORT_FILE, "a", buffering=1)
+    _export_file.write(json.dumps({
+        "trace_id": finished.trace_id,
+        "span_id": finished.span_id,
+        "parent_id": finished.parent_id,
+        "name": finished.name,
+        "service": TRACE_SERVICE_NAME,
+        "start": finished.start,
+        "duration_ms": round(duration * 1000, 3),
+        "attributes": finished.attributes,
+    }, default=str) + "\n")
+
+def add_tracing(app) -> None:
+    # Server span per request, continuing the caller's trace if it sent a
+    # traceparent; the response carries the server span's traceparent
+    @app.middleware("http")
+    async def trace_request(request, call_next):
+        parent = extract(request.headers)
+        with span(f"{request.method} {request.url.path}", parent, service=TRACE_SERVICE_NAME) as server:
+            response = await call_next(request)
+            server.attributes["status_code"] = response.status_code
+        response.headers[TRACEPARENT] = server.traceparent
+        return response
+
+def print_traces(path: str, trace_id: Optional[str] = None) -> None:
+    # Renders exported spans as one indented tree per trace
+    with open(path) as f:
+        spans = [json.loads(line) for line in f if line.strip()]
+    traces: dict[str, list[dict]] = {}
+    for s in spans:
+        if trace_id is None or s["trace_id"] == trace_id:
+            traces.setdefault(s["trace_id"], []).append(s)
+    for tid, members in traces.items():
+        ids = {s["span_id"] for s in members}
+        children: dict[Optional[str], list[dict]] = {}
+        for s in members:
+            # Spans whose parent wasn't exported (another process without an exporter) become roots
+            children.setdefault(s["parent_id"] if s["parent_id"] in ids else None, []).append(s)
+        start = min(s["start"] for s in members)
+        print(f"trace {tid}")
+
+        def show(parent_id, depth):
+            for s in sorted(children.get(parent_id, []), key=lambda s: s["start"]):
+                offset = (s["start"] - start) * 1000
+                print(f"  {'  ' * depth}{s['name']} [{s['service']}] +{offset:.1f}ms {s['duration_ms']:.1f}ms")
+                show(s["span_id"], depth + 1)
+
+        show(None, 0)
+
+if __name__ == "__main__":
+    # python -m shared.tracing spans.jsonl [trace_id]
+    print_traces(*sys.argv[1:3])
@@ -1,4 +1,4 @@
-from shared.api import get_app
+from shared.api import add_batch_route, get_app
 from shared.interfaces import SubtractionRequest, SubtractionResponse
 
 app = get_app()
@@ -6,4 +6,6 @@ app = get_app()
 @app.post("/subtract")
 async def subtract_numbers(request: SubtractionRequest) -> SubtractionResponse:
     result = request.a - request.b
-    return SubtractionResponse(result=result) 
\ No newline at end of file
+    return SubtractionResponse(result=result)
+
+add_batch_route(app, "/subtract/batch", subtract_numbers)